@@ -133,7 +133,7 @@ class LinearSVM(LinearClassifier):
   """ A subclass that uses the Multiclass SVM loss function """
 
   def loss(self, X_batch, y_batch, reg):
-    return svm_loss_vectorized(self.W, X_batch, y_batch, reg)
+    return svm_loss_sparse(self.W, X_batch, y_batch, reg)
 
 
 class Softmax(LinearClassifier):
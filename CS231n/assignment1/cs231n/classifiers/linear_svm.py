@@ -1,6 +1,11 @@
 import numpy as np
 from random import shuffle
 from past.builtins import xrange
+from scipy import sparse
+
+# Above this fraction of violating (i, j) pairs a dense BLAS product beats the
+# sparse one for computing dW in svm_loss_sparse
+SVM_SPARSE_MAX_DENSITY = 0.05
 
 def svm_loss_naive(W, X, y, reg):
   """
@@ -122,3 +127,45 @@ def svm_loss_vectorized(W, X, y, reg):
   #############################################################################
 
   return loss, dW
+
+
+def svm_loss_sparse(W, X, y, reg):
+  """
+  Structured SVM loss function that only keeps the violating classes.
+
+  The (i, j) pairs with a positive margin are found once and stored as a
+  sparse coefficient matrix, so dW comes from a sparse-times-dense product
+  whose cost grows with the number of violations rather than with N * C.
+  This pays off once most margins are zero, late in training or with many
+  classes. Denser violation patterns fall back on a dense product.
+
+  Inputs and outputs are the same as svm_loss_naive.
+  """
+  num_train = X.shape[0]
+  num_classes = W.shape[1]
+  rows = np.arange(num_train)
+
+  scores = X.dot(W)
+  margins = scores - scores[rows, y][:, np.newaxis] + 1.0
+  margins[rows, y] = 0.0
+  i, j = np.nonzero(margins > 0)
+  loss = np.sum(margins[i, j]) / num_train + reg * np.sum(W * W)
+
+  # Each violation adds X[i] to column j of dW and subtracts it from y[i]
+  counts = np.bincount(i, minlength=num_train)
+  if len(i) > SVM_SPARSE_MAX_DENSITY * num_train * num_classes:
+    coef = np.zeros_like(margins)
+    coef[i, j] = 1.0
+    coef[rows, y] = -counts
+    dW = X.T.dot(coef)
+  else:
+    violators = np.nonzero(counts)[0]
+    coef = sparse.csr_matrix(
+        (np.concatenate([np.ones(len(i), dtype=X.dtype),
+                         -counts[violators].astype(X.dtype)]),
+         (np.concatenate([i, violators]), np.concatenate([j, y[violators]]))),
+        shape=(num_train, num_classes))
+    dW = coef.T.dot(X).T
+  dW = dW / num_train + 2 * reg * W
+
+  return loss, dW
@@ -1,5 +1,7 @@
 from builtins import range
 from builtins import object
+import copy
+
 import numpy as np
 
 from cs231n.layers import *
@@ -155,6 +157,10 @@ class FullyConnectedNet(object):
         weight_scale=1e-2,
         dtype=np.float32,
         seed=None,
+        output_layer="softmax",
+        num_sampled=None,
+        proposal=None,
+        num_clusters=None,
     ):
         """
         Initialize a new FullyConnectedNet.
@@ -166,7 +172,9 @@ class FullyConnectedNet(object):
         - dropout: Scalar between 0 and 1 giving dropout strength. If dropout=1 then
           the network should not use dropout at all.
         - normalization: What type of normalization the network should use. Valid values
-          are "batchnorm", "layernorm", or None for no normalization (the default).
+          are "batchnorm", "batchnorm_fused", "layernorm", or None for no normalization
+          (the default). "batchnorm_fused" uses batchnorm_forward_fused and
+          batchnorm_backward_fused, which give the same results with a smaller cache.
         - reg: Scalar giving L2 regularization strength.
         - weight_scale: Scalar giving the standard deviation for random
           initialization of the weights.
@@ -175,8 +183,32 @@ class FullyConnectedNet(object):
           float64 for numeric gradient checking.
         - seed: If not None, then pass this random seed to the dropout layers. This
           will make the dropout layers deteriminstic so we can gradient check the
-          model.
+          model. Each dropout layer still draws its own mask, keyed on its index.
+          With a seed the mask changes only when dropout_param['step'] does, which
+          the Solver advances after every training step; without one each call to
+          loss() draws a new mask.
+        - output_layer: Loss used for training. Valid values are "softmax" (the
+          default), "sampled_softmax" and "hierarchical_softmax". At test time the
+          first two return the full scores of the last affine layer and the last
+          returns the full log-probabilities of its class tree.
+        - num_sampled: Number of classes sampled per minibatch by "sampled_softmax";
+          defaults to min(num_classes, 64).
+        - proposal: Proposal distribution for "sampled_softmax"; "uniform" (the
+          default), "log_uniform" or an array of shape (num_classes,).
+        - num_clusters: Number of class clusters for "hierarchical_softmax";
+          defaults to about sqrt(num_classes).
         """
+        if output_layer not in ("softmax", "sampled_softmax", "hierarchical_softmax"):
+            raise ValueError('Invalid output layer "%s"' % output_layer)
+        self.output_layer = output_layer
+        self.num_sampled = num_sampled or min(num_classes, 64)
+        self.proposal = proposal
+        self.output_rng = np.random.default_rng(seed)
+
+        # The gradients returned by loss() are multiplied by loss_scale. A Solver
+        # doing mixed-precision training sets this to keep small float16
+        # gradients from flushing to zero, and divides it back out.
+        self.loss_scale = 1.0
         self.normalization = normalization
         self.use_dropout = dropout != 1
         self.reg = reg
@@ -215,6 +247,12 @@ class FullyConnectedNet(object):
                 self.params['gamma'+str(i)] = np.ones(hidden_dims[i-1])
                 self.params['beta'+str(i)] = np.zeros(hidden_dims[i-1])
                 
+        # Initialize the cluster layer of the hierarchical softmax
+        if self.output_layer == "hierarchical_softmax":
+            num_clusters = num_clusters or int(np.ceil(np.sqrt(num_classes)))
+            self.params['Wc'] = weight_scale * np.random.randn(hidden_dims[-1], num_clusters)
+            self.params['bc'] = np.zeros(num_clusters)
+                
         pass
 
         # *****END OF YOUR CODE (DO NOT DELETE/MODIFY THIS LINE)*****
@@ -237,7 +275,7 @@ class FullyConnectedNet(object):
         # of the first batch normalization layer, self.bn_params[1] to the forward
         # pass of the second batch normalization layer, etc.
         self.bn_params = []
-        if self.normalization == "batchnorm":
+        if self.normalization in ("batchnorm", "batchnorm_fused"):
             self.bn_params = [{"mode": "train"} for i in range(self.num_layers - 1)]
         if self.normalization == "layernorm":
             self.bn_params = [{} for i in range(self.num_layers - 1)]
@@ -259,7 +297,7 @@ class FullyConnectedNet(object):
         # behave differently during training and testing.
         if self.use_dropout:
             self.dropout_param["mode"] = mode
-        if self.normalization == "batchnorm":
+        if self.normalization in ("batchnorm", "batchnorm_fused"):
             for bn_param in self.bn_params:
                 bn_param["mode"] = mode
         scores = None
@@ -295,6 +333,10 @@ class FullyConnectedNet(object):
             out,cache=batchnorm_forward(out,self.params['gamma'+str(i+1)],self.params['beta'+str(i+1)],self.bn_params[i])
             batchnorm_out.append(out)
             batchnorm_cache.append(cache)
+          if self.normalization == "batchnorm_fused":
+            out,cache=batchnorm_forward_fused(out,self.params['gamma'+str(i+1)],self.params['beta'+str(i+1)],self.bn_params[i])
+            batchnorm_out.append(out)
+            batchnorm_cache.append(cache)
           if self.normalization=="layernorm":
             out,cache=layernorm_forward(out,self.params['gamma'+str(i+1)],self.params['beta'+str(i+1)],self.bn_params[i])
             batchnorm_out.append(out)
@@ -303,12 +345,19 @@ class FullyConnectedNet(object):
           relu_out.append(out)
           relu_cache.append(cache)
           if self.use_dropout:
-            out,cache=dropout_forward(out,self.dropout_param)
+            out,cache=dropout_forward(out,dict(self.dropout_param,layer=i))
             dropout_cache.append(cache)
             dropout_out.append(out)
-        scores,cache=affine_forward(out,self.params['W'+str(self.num_layers)],self.params['b'+str(self.num_layers)])
-        affine_out.append(scores)
-        affine_cache.append(cache)
+        # The sampled and hierarchical losses work from the last hidden layer, so
+        # the full scores are only computed for softmax or at test time
+        W_out,b_out=self.params['W'+str(self.num_layers)],self.params['b'+str(self.num_layers)]
+        if self.output_layer == "hierarchical_softmax":
+          if mode == "test":
+            scores=hierarchical_softmax_scores(out,W_out,b_out,self.params['Wc'],self.params['bc'])
+        elif self.output_layer == "softmax" or mode == "test":
+          scores,cache=affine_forward(out,W_out,b_out)
+          affine_out.append(scores)
+          affine_cache.append(cache)
 
         #pass
 
@@ -339,7 +388,23 @@ class FullyConnectedNet(object):
         
 
         # Compute loss for all kinds of hidden layer patterns
-        loss,dout=softmax_loss(scores,y)
+        if self.output_layer == "sampled_softmax":
+          loss,dout,dw_out,db_out=sampled_softmax_loss(out,W_out,b_out,y,self.num_sampled,self.proposal,self.output_rng)
+        elif self.output_layer == "hierarchical_softmax":
+          loss,dout,dw_out,db_out,dwc,dbc=hierarchical_softmax_loss(out,W_out,b_out,self.params['Wc'],self.params['bc'],y)
+          loss+=0.5*self.reg*np.sum(np.square(self.params['Wc']))
+          grads['Wc']=dwc+self.reg*self.params['Wc']
+          grads['bc']=dbc
+        else:
+          loss,dout=softmax_loss(scores,y)
+        scale=self.loss_scale
+        if scale != 1:
+          dout=dout*scale
+          if self.output_layer != "softmax":
+            dw_out,db_out=dw_out*scale,db_out*scale
+          if 'Wc' in grads:
+            grads['Wc']*=scale
+            grads['bc']*=scale
         loss+=0.5*self.reg*np.sum(np.array([np.sum(np.square(self.params['W'+str(i+1)]))for i in range(self.num_layers)]))
         for i in range(self.num_layers,0,-1):
           if(i!=self.num_layers):
@@ -350,12 +415,19 @@ class FullyConnectedNet(object):
               dout,dgamma,dbeta=batchnorm_backward_alt(dout,batchnorm_cache[i-1])
               grads['gamma'+str(i)]=dgamma
               grads['beta'+str(i)]=dbeta
+            if self.normalization == "batchnorm_fused":
+              dout,dgamma,dbeta=batchnorm_backward_fused(dout,batchnorm_cache[i-1])
+              grads['gamma'+str(i)]=dgamma
+              grads['beta'+str(i)]=dbeta
             if self.normalization=="layernorm":
               dout,dgamma,dbeta=layernorm_backward(dout,batchnorm_cache[i-1])
               grads['gamma'+str(i)]=dgamma
               grads['beta'+str(i)]=dbeta
-          dout,dw,db=affine_backward(dout,affine_cache[i-1])
-          dw+=self.reg*self.params['W'+str(i)]
+          if i == self.num_layers and self.output_layer != "softmax":
+            dw,db=dw_out,db_out
+          else:
+            dout,dw,db=affine_backward(dout,affine_cache[i-1])
+          dw+=scale*self.reg*self.params['W'+str(i)]
           grads['W'+str(i)]=dw
           grads['b'+str(i)]=db
         
@@ -366,4 +438,49 @@ class FullyConnectedNet(object):
         #                             END OF YOUR CODE                             #
         ############################################################################
 
-        return loss, grads
\ No newline at end of file
+        return loss, grads
+
+    def fold_batchnorm(self, X=None, rtol=1e-4):
+        """
+        Export an inference-only copy of the network in which every batch
+        normalization layer is folded into the affine layer before it, using
+        the running statistics. The copy has no normalization layers, so its
+        test-time forward pass is just affine - relu blocks.
+
+        Inputs:
+        - X: Optional array of input data. If given, the test-time scores of
+          the folded copy are checked against those of this network.
+        - rtol: Largest allowed difference between the two sets of scores,
+          relative to the largest score magnitude.
+
+        Returns:
+        - folded: A FullyConnectedNet with normalization=None
+        """
+        if self.normalization not in ("batchnorm", "batchnorm_fused"):
+            raise ValueError('Cannot fold normalization "%s"' % self.normalization)
+
+        params = {}
+        for i in range(1, self.num_layers + 1):
+            w, b = self.params['W'+str(i)], self.params['b'+str(i)]
+            if i < self.num_layers:
+                w, b = fold_batchnorm(w, b, self.params['gamma'+str(i)],
+                                      self.params['beta'+str(i)], self.bn_params[i-1])
+            params['W'+str(i)] = w
+            params['b'+str(i)] = b
+        for k in ('Wc', 'bc'):
+            if k in self.params:
+                params[k] = self.params[k]
+
+        folded = copy.copy(self)
+        folded.normalization = None
+        folded.bn_params = []
+        folded.dropout_param = dict(self.dropout_param)
+        folded.params = params
+
+        if X is not None:
+            scores = self.loss(X)
+            folded_scores = folded.loss(X)
+            error = np.max(np.abs(scores - folded_scores))
+            if error > rtol * max(np.max(np.abs(scores)), 1.0):
+                raise ValueError('Folded scores differ by %g' % error)
+        return folded
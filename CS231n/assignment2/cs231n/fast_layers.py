@@ -1,20 +1,42 @@
 from __future__ import print_function
+import json
+import os
+import platform
+import tempfile
+import timeit
+import tracemalloc
+from collections import OrderedDict
+
 import numpy as np
+try:
+    import fcntl
+except ImportError:
+    # Not available on Windows, where concurrent autotune writers can drop
+    # each other's decisions; see _save_autotune_decision
+    fcntl = None
 try:
     from cs231n.im2col_cython import col2im_cython, im2col_cython
-    from cs231n.im2col_cython import col2im_6d_cython
+    HAS_CYTHON = True
 except ImportError:
-    print('run the following from the cs231n directory and try again:')
+    HAS_CYTHON = False
+    print('im2col_cython is not built; the im2col conv backend is disabled.')
+    print('To build it, run the following from the cs231n directory and')
+    print('restart your iPython kernel:')
     print('python setup.py build_ext --inplace')
-    print('You may also need to restart your iPython kernel')
 
 from cs231n.im2col import *
+from cs231n.layers import conv_forward_vectorized, conv_backward_vectorized
+from cs231n.layers import max_pool_forward_naive, max_pool_backward_naive
+from cs231n.layers import avg_pool_forward_naive, avg_pool_backward_naive
 
 
 def conv_forward_im2col(x, w, b, conv_param):
     """
     A fast implementation of the forward pass for a convolutional layer
     based on im2col and col2im.
+
+    If conv_param['cache_cols'] is False, x_cols is dropped from the cache
+    and recomputed in the backward pass; see conv_forward_strides.
     """
     N, C, H, W = x.shape
     num_filters, _, filter_height, filter_width = w.shape
@@ -36,50 +58,56 @@ def conv_forward_im2col(x, w, b, conv_param):
     out = res.reshape(w.shape[0], out.shape[2], out.shape[3], x.shape[0])
     out = out.transpose(3, 0, 1, 2)
 
+    if not conv_param.get('cache_cols', True):
+        x_cols = None
     cache = (x, w, b, conv_param, x_cols)
     return out, cache
 
 
 def conv_forward_strides(x, w, b, conv_param):
+    """
+    A fast implementation of the forward pass for a convolutional layer
+    based on im2col with stride tricks followed by a GEMM.
+
+    conv_param may contain:
+    - 'cache_cols': Default True. x_cols is about HH * WW times larger than x,
+      so setting it to False keeps only x in the cache and rebuilds x_cols in
+      conv_backward_strides, trading one extra im2col per step for much less
+      memory held between forward and backward.
+    - 'batch_tile': If given, im2col and the GEMM run on this many images at
+      a time, writing into a preallocated output, so peak memory is bounded
+      by the tile rather than the batch. x_cols is then never cached.
+    """
     N, C, H, W = x.shape
     F, _, HH, WW = w.shape
     stride, pad = conv_param['stride'], conv_param['pad']
+    tile = conv_param.get('batch_tile') or N
 
     # Check dimensions
     #assert (W + 2 * pad - WW) % stride == 0, 'width does not work'
     #assert (H + 2 * pad - HH) % stride == 0, 'height does not work'
 
-    # Pad the input
-    p = pad
-    x_padded = np.pad(x, ((0, 0), (0, 0), (p, p), (p, p)), mode='constant')
-
     # Figure out output dimensions
-    H += 2 * pad
-    W += 2 * pad
-    out_h = (H - HH) // stride + 1
-    out_w = (W - WW) // stride + 1
-
-    # Perform an im2col operation by picking clever strides
-    shape = (C, HH, WW, N, out_h, out_w)
-    strides = (H * W, W, 1, C * H * W, stride * W, stride)
-    strides = x.itemsize * np.array(strides)
-    x_stride = np.lib.stride_tricks.as_strided(x_padded,
-                  shape=shape, strides=strides)
-    x_cols = np.ascontiguousarray(x_stride)
-    x_cols.shape = (C * HH * WW, N * out_h * out_w)
-
-    # Now all our convolutions are a big matrix multiply
-    res = w.reshape(F, -1).dot(x_cols) + b.reshape(-1, 1)
-
-    # Reshape the output
-    res.shape = (F, N, out_h, out_w)
-    out = res.transpose(1, 0, 2, 3)
-
-    # Be nice and return a contiguous array
-    # The old version of conv_forward_fast doesn't do this, so for a fair
-    # comparison we won't either
-    out = np.ascontiguousarray(out)
-
+    out_h = (H + 2 * pad - HH) // stride + 1
+    out_w = (W + 2 * pad - WW) // stride + 1
+
+    # Writing each tile into a preallocated array also gives the caller a
+    # contiguous output without a separate copy
+    out = np.empty((N, F, out_h, out_w), dtype=np.result_type(x, w, b))
+    w_cols = w.reshape(F, -1)
+    for n in range(0, N, tile):
+        # Perform an im2col operation by picking clever strides
+        x_cols = im2col_strides(x[n:n + tile], HH, WW, pad, stride)
+
+        # Now all our convolutions are a big matrix multiply
+        res = w_cols.dot(x_cols) + b.reshape(-1, 1)
+
+        # Reshape the output
+        res.shape = (F, -1, out_h, out_w)
+        out[n:n + tile] = res.transpose(1, 0, 2, 3)
+
+    if tile < N or not conv_param.get('cache_cols', True):
+        x_cols = None
     cache = (x, w, b, conv_param, x_cols)
     return out, cache
 
@@ -87,6 +115,7 @@ def conv_forward_strides(x, w, b, conv_param):
 def conv_backward_strides(dout, cache):
     x, w, b, conv_param, x_cols = cache
     stride, pad = conv_param['stride'], conv_param['pad']
+    tile = conv_param.get('batch_tile') or x.shape[0]
 
     N, C, H, W = x.shape
     F, _, HH, WW = w.shape
@@ -94,14 +123,25 @@ def conv_backward_strides(dout, cache):
 
     db = np.sum(dout, axis=(0, 2, 3))
 
-    dout_reshaped = dout.transpose(1, 0, 2, 3).reshape(F, -1)
-    dw = dout_reshaped.dot(x_cols.T).reshape(w.shape)
+    w_cols = w.reshape(F, -1)
+    dw = np.zeros(w_cols.shape, dtype=np.result_type(dout, x))
+    dx = np.empty(x.shape, dtype=np.result_type(dout, w))
+    for n in range(0, N, tile):
+        x_tile = x[n:n + tile]
+        if x_cols is None:
+            tile_cols = im2col_strides(x_tile, HH, WW, pad, stride)
+        else:
+            tile_cols = x_cols
 
-    dx_cols = w.reshape(F, -1).T.dot(dout_reshaped)
-    dx_cols.shape = (C, HH, WW, N, out_h, out_w)
-    dx = col2im_6d_cython(dx_cols, N, C, H, W, HH, WW, pad, stride)
+        dout_reshaped = dout[n:n + tile].transpose(1, 0, 2, 3).reshape(F, -1)
+        dw += dout_reshaped.dot(tile_cols.T)
 
-    return dx, dw, db
+        dx_cols = w_cols.T.dot(dout_reshaped)
+        dx_cols.shape = (C, HH, WW, x_tile.shape[0], out_h, out_w)
+        dx[n:n + tile] = col2im_6d_strided(dx_cols, x_tile.shape[0], C, H, W,
+                                           HH, WW, pad, stride)
+
+    return dx, dw.reshape(w.shape), db
 
 
 def conv_backward_im2col(dout, cache):
@@ -115,6 +155,8 @@ def conv_backward_im2col(dout, cache):
     db = np.sum(dout, axis=(0, 2, 3))
 
     num_filters, _, filter_height, filter_width = w.shape
+    if x_cols is None:
+        x_cols = im2col_cython(x, filter_height, filter_width, pad, stride)
     dout_reshaped = dout.transpose(1, 2, 3, 0).reshape(num_filters, -1)
     dw = dout_reshaped.dot(x_cols.T).reshape(w.shape)
 
@@ -126,18 +168,598 @@ def conv_backward_im2col(dout, cache):
     return dx, dw, db
 
 
-conv_forward_fast = conv_forward_strides
-conv_backward_fast = conv_backward_strides
+# Winograd F(2x2, 3x3) transforms from Lavin & Gray, "Fast Algorithms for
+# Convolutional Neural Networks". Each 4x4 input tile yields a 2x2 output
+# tile using 16 multiplies instead of 36.
+WINOGRAD_G = np.array([[1.0, 0.0, 0.0],
+                       [0.5, 0.5, 0.5],
+                       [0.5, -0.5, 0.5],
+                       [0.0, 0.0, 1.0]])
+WINOGRAD_BT = np.array([[1.0, 0.0, -1.0, 0.0],
+                        [0.0, 1.0, 1.0, 0.0],
+                        [0.0, -1.0, 1.0, 0.0],
+                        [0.0, 1.0, 0.0, -1.0]])
+WINOGRAD_AT = np.array([[1.0, 1.0, 1.0, 0.0],
+                        [0.0, 1.0, -1.0, -1.0]])
+
+
+def _winograd_combine(T, blocks, out=None):
+    """
+    Returns [sum_j T[i, j] * blocks[j] for each row i of T], written into
+    out[i] if out is given. The Winograd data transforms only contain 0 and
+    +-1, so each output is one or two whole-array additions.
+    """
+    if out is None:
+        out = [np.empty_like(blocks[0]) for _ in T]
+    for row, dest in zip(T, out):
+        terms = [(t, block) for t, block in zip(row, blocks) if t != 0]
+        assert all(abs(t) == 1 for t, _ in terms), 'Expected a +-1 transform'
+        (t0, b0), rest = terms[0], terms[1:]
+        if not rest:
+            np.multiply(b0, t0, out=dest)
+            continue
+        (t1, b1), rest = rest[0], rest[1:]
+        if t0 == t1:
+            np.add(b0, b1, out=dest)
+            if t0 == -1:
+                np.negative(dest, out=dest)
+        elif t0 == 1:
+            np.subtract(b0, b1, out=dest)
+        else:
+            np.subtract(b1, b0, out=dest)
+        for t, block in rest:
+            if t == 1:
+                np.add(dest, block, out=dest)
+            else:
+                np.subtract(dest, block, out=dest)
+    return out
+
+
+def _winograd_tiles(H, W, pad):
+    """
+    Returns the output size and the number of 2x2 output tiles per axis.
+    """
+    out_h, out_w = H + 2 * pad - 2, W + 2 * pad - 2
+    return out_h, out_w, (out_h + 1) // 2, (out_w + 1) // 2
+
+
+def _winograd_filter_transform(w, dtype):
+    """
+    Applies G g G^T to every 3x3 filter; returns an array of shape (16, F, C).
+    """
+    F, C = w.shape[:2]
+    G = WINOGRAD_G.astype(dtype)
+    U = np.matmul(np.matmul(G, w), G.T)
+    return np.ascontiguousarray(U.transpose(2, 3, 0, 1)).reshape(16, F, C)
+
+
+def _to_phases(x, tiles_h, tiles_w):
+    """
+    Rearranges x of shape (N, C, 2 * tiles_h, 2 * tiles_w) into a contiguous
+    array of shape (2, 2, C, N, tiles_h, tiles_w) where [r, s] holds the pixels
+    at even / odd rows r and columns s. Row 2 * h + j of an image is then
+    phase j % 2 at index h + j // 2, so every tile offset is a plain slice.
+    """
+    N, C = x.shape[:2]
+    x = x.reshape(N, C, tiles_h, 2, tiles_w, 2)
+    return np.ascontiguousarray(x.transpose(3, 5, 1, 0, 2, 4))
+
+
+def _from_phases(x):
+    """
+    Inverse of _to_phases; returns an array of shape (N, C, 2 * th, 2 * tw).
+    """
+    _, _, C, N, tiles_h, tiles_w = x.shape
+    x = x.transpose(3, 2, 4, 0, 5, 1)
+    return x.reshape(N, C, 2 * tiles_h, 2 * tiles_w)
+
+
+def conv_forward_winograd(x, w, b, conv_param):
+    """
+    A fast implementation of the forward pass for a 3x3, stride 1
+    convolutional layer based on the Winograd F(2x2, 3x3) algorithm.
+
+    Filters and overlapping 4x4 input tiles are moved into the Winograd
+    domain, where the convolution becomes 16 independent (F, C) x (C, tiles)
+    matrix products; this needs about 2.25x fewer multiplies than im2col.
+    """
+    N, C, H, W = x.shape
+    F, _, HH, WW = w.shape
+    stride, pad = conv_param['stride'], conv_param['pad']
+    assert HH == WW == 3 and stride == 1, 'Winograd needs 3x3 stride 1 filters'
+    out_h, out_w, tiles_h, tiles_w = _winograd_tiles(H, W, pad)
+
+    U = _winograd_filter_transform(w, np.result_type(x, w))
+
+    # Input transform B^T d B, applied to every tile at once. The bottom and
+    # right edges get a little extra padding so that odd sizes tile too.
+    x_padded = np.pad(x, ((0, 0), (0, 0), (pad, pad + 2 * tiles_h - out_h),
+                          (pad, pad + 2 * tiles_w - out_w)), mode='constant')
+    x_phases = _to_phases(x_padded, tiles_h + 1, tiles_w + 1)
+    V = np.empty((4, 4, C, N, tiles_h, tiles_w), dtype=x.dtype)
+    rows = [x_phases[j % 2, :, :, :, j // 2:j // 2 + tiles_h] for j in range(4)]
+    for i, row in enumerate(_winograd_combine(WINOGRAD_BT, rows)):
+        cols = [row[k % 2, ..., k // 2:k // 2 + tiles_w] for k in range(4)]
+        _winograd_combine(WINOGRAD_BT, cols, out=V[i])
+    V.shape = (16, C, -1)
+
+    M = np.matmul(U, V)
+    M.shape = (4, 4, F, N, tiles_h, tiles_w)
+
+    # Output transform A^T m A gives the 2x2 outputs of every tile
+    Y = np.empty((2, 2, F, N, tiles_h, tiles_w), dtype=M.dtype)
+    for a, row in enumerate(_winograd_combine(WINOGRAD_AT, list(M))):
+        _winograd_combine(WINOGRAD_AT, list(row), out=Y[a])
+    out = _from_phases(Y)[:, :, :out_h, :out_w] + b.reshape(1, -1, 1, 1)
+
+    cache = (x, w, b, conv_param, V)
+    return out, cache
+
+
+def conv_backward_winograd(dout, cache):
+    """
+    A fast implementation of the backward pass for a 3x3, stride 1
+    convolutional layer based on the Winograd F(2x2, 3x3) algorithm.
+
+    Every transform in the forward pass is linear, so the gradients are the
+    transposed transforms applied in reverse order.
+    """
+    x, w, b, conv_param, V = cache
+    pad = conv_param['pad']
+    N, C, H, W = x.shape
+    F = w.shape[0]
+    out_h, out_w, tiles_h, tiles_w = _winograd_tiles(H, W, pad)
+
+    db = np.sum(dout, axis=(0, 2, 3))
+
+    U = _winograd_filter_transform(w, np.result_type(x, w))
+
+    # Transposed output transform A dy A^T
+    dout_padded = np.pad(dout, ((0, 0), (0, 0), (0, 2 * tiles_h - out_h),
+                                (0, 2 * tiles_w - out_w)), mode='constant')
+    dY = _to_phases(dout_padded, tiles_h, tiles_w)
+    dM = np.empty((4, 4, F, N, tiles_h, tiles_w), dtype=dout.dtype)
+    for i, row in enumerate(_winograd_combine(WINOGRAD_AT.T, list(dY))):
+        _winograd_combine(WINOGRAD_AT.T, list(row), out=dM[i])
+    dM.shape = (16, F, -1)
+
+    dU = np.matmul(dM, V.transpose(0, 2, 1)).reshape(4, 4, F, C)
+    G = WINOGRAD_G.astype(dU.dtype)
+    dw = np.matmul(np.matmul(G.T, dU.transpose(2, 3, 0, 1)), G)
+
+    dV = np.matmul(U.transpose(0, 2, 1), dM)
+    dV.shape = (4, 4, C, N, tiles_h, tiles_w)
+
+    # Transposed input transform B dv B^T; neighbouring tiles overlap by two
+    # pixels, so each of the 16 tile offsets is added as one slice
+    dx_phases = np.zeros((2, 2, C, N, tiles_h + 1, tiles_w + 1), dtype=dV.dtype)
+    for j, row in enumerate(_winograd_combine(WINOGRAD_BT.T, list(dV))):
+        for k, d in enumerate(_winograd_combine(WINOGRAD_BT.T, list(row))):
+            dx_phases[j % 2, k % 2, :, :, j // 2:j // 2 + tiles_h,
+                      k // 2:k // 2 + tiles_w] += d
+    dx = _from_phases(dx_phases)[:, :, pad:pad + H, pad:pad + W]
+
+    return dx, dw, db
+
+
+def conv_forward_fft(x, w, b, conv_param):
+    """
+    A fast implementation of the forward pass for a convolutional layer
+    based on the FFT.
+
+    The padded input and the flipped filters are moved to the frequency
+    domain with rfft2, where the convolution is a per-frequency (N, C) x
+    (C, F) product, so the cost no longer grows with HH * WW. A circular
+    convolution the size of the padded input is enough: the valid outputs
+    never see the wrap-around.
+    """
+    N, C, H, W = x.shape
+    F, _, HH, WW = w.shape
+    stride, pad = conv_param['stride'], conv_param['pad']
+    H_pad, W_pad = H + 2 * pad, W + 2 * pad
+    out_h = (H_pad - HH) // stride + 1
+    out_w = (W_pad - WW) // stride + 1
+
+    x_padded = np.pad(x, ((0, 0), (0, 0), (pad, pad), (pad, pad)), 'constant')
+    x_freq = _to_freq_rows(np.fft.rfft2(x_padded))
+    w_freq = _to_freq_rows(np.fft.rfft2(w[:, :, ::-1, ::-1], s=(H_pad, W_pad)))
+
+    # (freqs, N, C) x (freqs, C, F) -> (freqs, N, F)
+    y_freq = np.matmul(x_freq, w_freq.transpose(0, 2, 1))
+    y = np.fft.irfft2(_from_freq_rows(y_freq, H_pad), s=(H_pad, W_pad))
+
+    out = y[:, :, HH - 1::stride, WW - 1::stride][:, :, :out_h, :out_w]
+    out = out.astype(np.result_type(x, w), copy=False) + b.reshape(1, -1, 1, 1)
+
+    cache = (x, w, b, conv_param, x_freq, w_freq)
+    return out, cache
+
+
+def conv_backward_fft(dout, cache):
+    """
+    A fast implementation of the backward pass for a convolutional layer
+    based on the FFT. Both gradients are correlations with dout, i.e.
+    products with the conjugated spectra cached by conv_forward_fft.
+    """
+    x, w, b, conv_param, x_freq, w_freq = cache
+    stride, pad = conv_param['stride'], conv_param['pad']
+    N, C, H, W = x.shape
+    F, _, HH, WW = w.shape
+    H_pad, W_pad = H + 2 * pad, W + 2 * pad
+    _, _, out_h, out_w = dout.shape
+
+    db = np.sum(dout, axis=(0, 2, 3))
+
+    # Scatter dout back to the positions of the circular output it came from
+    dy = np.zeros((N, F, H_pad, W_pad), dtype=dout.dtype)
+    dy[:, :, HH - 1:HH - 1 + stride * out_h:stride,
+       WW - 1:WW - 1 + stride * out_w:stride] = dout
+    dy_freq = _to_freq_rows(np.fft.rfft2(dy))
+
+    dx_freq = np.matmul(dy_freq, w_freq.conj())
+    dx_padded = np.fft.irfft2(_from_freq_rows(dx_freq, H_pad), s=(H_pad, W_pad))
+    dx = dx_padded[:, :, pad:pad + H, pad:pad + W]
+
+    dw_freq = np.matmul(dy_freq.transpose(0, 2, 1), x_freq.conj())
+    dw_flipped = np.fft.irfft2(_from_freq_rows(dw_freq, H_pad), s=(H_pad, W_pad))
+    dw = dw_flipped[:, :, HH - 1::-1, WW - 1::-1]
+
+    dtype = np.result_type(dout, x, w)
+    return dx.astype(dtype), dw.astype(dtype), db
+
+
+def _to_freq_rows(x_freq):
+    """
+    Reshapes a spectrum of shape (A, B, H, W') to (H * W', A, B) so that a
+    batched matmul contracts over channels at every frequency.
+    """
+    A, B = x_freq.shape[:2]
+    return np.ascontiguousarray(x_freq.reshape(A, B, -1).transpose(2, 0, 1))
+
+
+def _from_freq_rows(x_freq, H):
+    """
+    Inverse of _to_freq_rows for a spectrum with H rows.
+    """
+    _, A, B = x_freq.shape
+    return x_freq.transpose(1, 2, 0).reshape(A, B, H, -1)
+
+
+# Maps a backend name to its (forward, backward) pair. Only backends whose
+# kernels are importable in this process are registered.
+CONV_BACKENDS = {
+    'strides': (conv_forward_strides, conv_backward_strides),
+    'numpy': (conv_forward_vectorized, conv_backward_vectorized),
+    'winograd': (conv_forward_winograd, conv_backward_winograd),
+    'fft': (conv_forward_fft, conv_backward_fft),
+}
+if HAS_CYTHON:
+    CONV_BACKENDS['im2col'] = (conv_forward_im2col, conv_backward_im2col)
+
+# The conv_param keys that bound memory use, and the backends that read them.
+# The winograd, fft and numpy backends ignore both, so 'auto' stays on strides
+# and 'autotune' only times backends that honour every key a layer sets.
+CONV_MEMORY_OPTIONS = {
+    'cache_cols': ('strides', 'im2col'),
+    'batch_tile': ('strides',),
+}
+
+# 'auto' picks a backend per call from the layer shape and 'autotune' times
+# every backend once per layer shape; see select_conv_backend
+FFT_MIN_KERNEL_AREA = 25
+_active_conv_backend = 'auto'
+
+# The backend select_conv_backend last returned for each layer signature,
+# most recently used last; bounded like the autotuner's LRU
+_last_conv_backends = OrderedDict()
+
+
+def active_backend(x=None, w=None, conv_param=None):
+    """
+    Returns the name of the backend that conv_forward_fast currently uses,
+    or 'auto' / 'autotune' if it is chosen per layer by select_conv_backend.
+
+    Given a layer's x, w and conv_param, returns the backend that layer last
+    ran with instead, or None if conv_forward_fast has not seen it.
+    """
+    if x is None:
+        return _active_conv_backend
+    return _last_conv_backends.get(_conv_signature(x, w, conv_param))
+
+
+def last_conv_backends():
+    """
+    Returns a dictionary from layer signature (see autotune_conv_backend) to
+    the backend conv_forward_fast last ran that layer with.
+    """
+    return dict(_last_conv_backends)
+
+
+def set_conv_backend(name):
+    """
+    Selects the backend used by conv_forward_fast / conv_backward_fast.
+    Layers the backend cannot run, e.g. strided layers for 'winograd', use
+    'strides' instead.
+
+    Inputs:
+    - name: A key of CONV_BACKENDS, 'auto' or 'autotune'.
+    """
+    global _active_conv_backend
+    modes = ['auto', 'autotune']
+    if name not in modes and name not in CONV_BACKENDS:
+        raise ValueError('Unavailable conv backend "%s"; choose from %s'
+                         % (name, ', '.join(modes + sorted(CONV_BACKENDS))))
+    _active_conv_backend = name
+
+
+def select_conv_backend(x, w, conv_param):
+    """
+    Returns the name of the backend conv_forward_fast uses for this layer,
+    and records it for active_backend / last_conv_backends.
+    """
+    method = _choose_conv_backend(x, w, conv_param)
+    key = _conv_signature(x, w, conv_param)
+    _last_conv_backends[key] = method
+    _last_conv_backends.move_to_end(key)
+    if len(_last_conv_backends) > AUTOTUNE_CACHE_SIZE:
+        _last_conv_backends.popitem(last=False)
+    return method
+
+
+def _choose_conv_backend(x, w, conv_param):
+    if _active_conv_backend == 'autotune':
+        return autotune_conv_backend(x, w, conv_param)
+    if _active_conv_backend != 'auto':
+        # A fixed backend that cannot run this layer falls back to strides
+        # rather than failing the whole network
+        if _conv_backend_supports(_active_conv_backend, x, w, conv_param):
+            return _active_conv_backend
+        return 'strides'
+    # Only the strides backend honours every memory option; see
+    # CONV_MEMORY_OPTIONS
+    if any(key in conv_param for key in CONV_MEMORY_OPTIONS):
+        return 'strides'
+    F, C, HH, WW = w.shape
+    # The Winograd transforms cost O(C + F) per tile while the GEMM savings
+    # scale with C * F, so thin layers (e.g. on RGB input) stay on im2col
+    if HH == WW == 3 and conv_param['stride'] == 1 and min(F, C) >= 32:
+        return 'winograd'
+    # The FFT cost does not depend on the kernel size, but it pays for
+    # transforming every channel, which thin layers cannot amortise
+    if (HH * WW >= FFT_MIN_KERNEL_AREA and conv_param['stride'] == 1
+            and min(F, C) >= 16):
+        return 'fft'
+    return 'strides'
+
+
+# Autotuner decisions, most recently used last, and the optional JSON file
+# that shares them between processes. The file maps a CPU model to a
+# dictionary from layer signature to backend name.
+AUTOTUNE_CACHE_SIZE = 256
+AUTOTUNE_REPEATS = 2
+_autotune_decisions = OrderedDict()
+_autotune_file = None
+
+
+def _cpu_model():
+    """
+    Returns a string identifying the CPU, used to key the autotune file.
+    """
+    try:
+        with open('/proc/cpuinfo') as f:
+            for line in f:
+                if line.startswith('model name'):
+                    return line.split(':', 1)[1].strip()
+    except IOError:
+        pass
+    return platform.processor() or platform.machine()
+
+
+def _conv_signature(x, w, conv_param):
+    N, C, H, W = x.shape
+    F, _, HH, WW = w.shape
+    fields = (N, C, H, W, F, HH, WW, conv_param['stride'], conv_param['pad'],
+              np.result_type(x, w).name)
+    # Memory options narrow the candidate backends, so they are part of the key
+    options = ['%s=%s' % (key, conv_param[key])
+               for key in sorted(CONV_MEMORY_OPTIONS) if key in conv_param]
+    return ','.join([str(f) for f in fields] + options)
+
+
+def _conv_backend_supports(method, x, w, conv_param):
+    N, C, H, W = x.shape
+    F, _, HH, WW = w.shape
+    stride, pad = conv_param['stride'], conv_param['pad']
+    for key, backends in CONV_MEMORY_OPTIONS.items():
+        if key in conv_param and method not in backends:
+            return False
+    if method == 'winograd':
+        return HH == WW == 3 and stride == 1
+    if method == 'im2col':
+        return ((H + 2 * pad - HH) % stride == 0 and
+                (W + 2 * pad - WW) % stride == 0)
+    return True
+
+
+def _read_autotune_file():
+    if _autotune_file is None or not os.path.exists(_autotune_file):
+        return {}
+    # A missing or unreadable file just means no decisions have been shared
+    try:
+        with open(_autotune_file) as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return {}
+
+
+def _write_autotune_file(decisions):
+    # Write to a temporary file next to the target and rename it into place,
+    # so that concurrent readers never see a partly written file
+    dirname = os.path.dirname(os.path.abspath(_autotune_file))
+    fd, tmp = tempfile.mkstemp(dir=dirname, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(decisions, f, indent=2, sort_keys=True)
+        os.replace(tmp, _autotune_file)
+    except BaseException:
+        os.remove(tmp)
+        raise
+
+
+def _save_autotune_decision(cpu, key, method):
+    # Hold an exclusive lock on a sidecar file across the read-modify-write,
+    # so that processes tuning different layers at once keep each other's
+    # decisions. Without fcntl an entry can be lost, which costs a re-tune.
+    with open(_autotune_file + '.lock', 'a') as lock:
+        if fcntl is not None:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            # Re-read so that decisions made by other processes are kept
+            decisions = _read_autotune_file()
+            decisions.setdefault(cpu, {})[key] = method
+            _write_autotune_file(decisions)
+        finally:
+            if fcntl is not None:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def set_autotune_cache_file(filename):
+    """
+    Persists autotuner decisions to a JSON file so that later processes on
+    the same CPU model skip the timing runs. Pass None to stop using a file.
+
+    Processes may share the file: updates are serialised with a lock on
+    filename + '.lock' where fcntl is available. Elsewhere, e.g. on Windows,
+    concurrent writers can drop each other's entries, which only costs
+    re-tuning those layers.
+    """
+    global _autotune_file
+    _autotune_file = filename
+
+
+def autotune_conv_backend(x, w, conv_param):
+    """
+    Returns the fastest backend for this layer signature.
+
+    On the first sight of a (N, C, H, W, F, HH, WW, stride, pad, dtype)
+    signature, plus any CONV_MEMORY_OPTIONS set in conv_param, every
+    applicable backend that honours those options runs a forward and backward pass
+    AUTOTUNE_REPEATS times and the fastest one is remembered, both in an LRU
+    of AUTOTUNE_CACHE_SIZE entries and in the autotune file if one is set.
+    """
+    key = _conv_signature(x, w, conv_param)
+    if key in _autotune_decisions:
+        _autotune_decisions.move_to_end(key)
+        return _autotune_decisions[key]
+
+    cpu = _cpu_model()
+    method = _read_autotune_file().get(cpu, {}).get(key)
+    if method not in CONV_BACKENDS:
+        b = np.zeros(w.shape[0], dtype=w.dtype)
+        best_time = None
+        for name, (forward, backward) in sorted(CONV_BACKENDS.items()):
+            if not _conv_backend_supports(name, x, w, conv_param):
+                continue
+            out, _ = forward(x, w, b, conv_param)
+            dout = np.ones_like(out)
+            elapsed = min(timeit.repeat(
+                lambda: backward(dout, forward(x, w, b, conv_param)[1]),
+                number=1, repeat=AUTOTUNE_REPEATS))
+            if best_time is None or elapsed < best_time:
+                method, best_time = name, elapsed
+
+        if _autotune_file is not None:
+            _save_autotune_decision(cpu, key, method)
+
+    _autotune_decisions[key] = method
+    if len(_autotune_decisions) > AUTOTUNE_CACHE_SIZE:
+        _autotune_decisions.popitem(last=False)
+    return method
+
+
+def conv_forward_fast(x, w, b, conv_param):
+    """
+    A fast implementation of the forward pass for a convolutional layer.
+
+    This dispatches to the backend given by select_conv_backend; the backend
+    name is stored in the cache so that the backward pass matches it.
+    """
+    method = select_conv_backend(x, w, conv_param)
+    forward, _ = CONV_BACKENDS[method]
+    out, real_cache = forward(x, w, b, conv_param)
+    cache = (method, real_cache)
+    return out, cache
+
+
+def conv_backward_fast(dout, cache):
+    """
+    A fast implementation of the backward pass for a convolutional layer.
+
+    This uses the backend that was used to generate the cache.
+    """
+    method, real_cache = cache
+    if method not in CONV_BACKENDS:
+        raise ValueError('Unrecognized method "%s"' % method)
+    _, backward = CONV_BACKENDS[method]
+    return backward(dout, real_cache)
+
+
+def conv_peak_bytes(x, w, b, conv_param, forward=None, backward=None):
+    """
+    Measures the memory used by one forward and backward pass of a conv layer,
+    e.g. to compare conv_param['cache_cols'] = True against False.
+
+    Inputs:
+    - x, w, b, conv_param: As for conv_forward_fast
+    - forward, backward: The pair to measure; defaults to conv_forward_fast
+      and conv_backward_fast.
+
+    Returns a tuple of:
+    - cache_bytes: Bytes of array data held by the cache between the passes
+    - peak_bytes: Peak bytes allocated during both passes, as seen by
+      tracemalloc; the inputs themselves are not counted. If tracemalloc
+      was already tracing, it is restarted, which discards earlier traces.
+    """
+    forward = forward or conv_forward_fast
+    backward = backward or conv_backward_fast
+    out, _ = forward(x, w, b, conv_param)
+    dout = np.ones_like(out)
+    del out
+
+    def nbytes(obj):
+        if isinstance(obj, np.ndarray):
+            return obj.nbytes if obj.base is None else 0
+        if isinstance(obj, (tuple, list)):
+            return sum(nbytes(o) for o in obj)
+        return 0
+
+    # Restarting tracemalloc resets its peak; tracemalloc.reset_peak() would
+    # do the same without dropping traces, but needs Python 3.9
+    was_tracing = tracemalloc.is_tracing()
+    if was_tracing:
+        tracemalloc.stop()
+    tracemalloc.start()
+    try:
+        out, cache = forward(x, w, b, conv_param)
+        cache_bytes = nbytes(cache) - nbytes((x, w, b))
+        backward(dout, cache)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+        if was_tracing:
+            tracemalloc.start()
+    return cache_bytes, peak
 
 
 def max_pool_forward_fast(x, pool_param):
     """
     A fast implementation of the forward pass for a max pooling layer.
 
-    This chooses between the reshape method and the im2col method. If the pooling
-    regions are square and tile the input image, then we can use the reshape
-    method which is very fast. Otherwise we fall back on the im2col method, which
-    is not much faster than the naive method.
+    This chooses between the reshape method and the strided method. If the
+    pooling regions are square and tile the input image, then we can use the
+    reshape method which is very fast. Otherwise we fall back on the strided
+    window view from max_pool_forward_naive, which handles overlapping regions
+    such as 3x3 pools with stride 2 and only caches the argmax indices.
     """
     N, C, H, W = x.shape
     pool_height, pool_width = pool_param['pool_height'], pool_param['pool_width']
@@ -149,8 +771,8 @@ def max_pool_forward_fast(x, pool_param):
         out, reshape_cache = max_pool_forward_reshape(x, pool_param)
         cache = ('reshape', reshape_cache)
     else:
-        out, im2col_cache = max_pool_forward_im2col(x, pool_param)
-        cache = ('im2col', im2col_cache)
+        out, strided_cache = max_pool_forward_naive(x, pool_param)
+        cache = ('strided', strided_cache)
     return out, cache
 
 
@@ -158,12 +780,14 @@ def max_pool_backward_fast(dout, cache):
     """
     A fast implementation of the backward pass for a max pooling layer.
 
-    This switches between the reshape method an the im2col method depending on
+    This switches between the reshape, strided and im2col methods depending on
     which method was used to generate the cache.
     """
     method, real_cache = cache
     if method == 'reshape':
         return max_pool_backward_reshape(dout, real_cache)
+    elif method == 'strided':
+        return max_pool_backward_naive(dout, real_cache)
     elif method == 'im2col':
         return max_pool_backward_im2col(dout, real_cache)
     else:
@@ -175,7 +799,9 @@ def max_pool_forward_reshape(x, pool_param):
     A fast implementation of the forward pass for the max pooling layer that uses
     some clever reshaping.
 
-    This can only be used for square pooling regions that tile the input.
+    This can only be used for square pooling regions that tile the input. The
+    cache keeps the offset of the winning element inside each pooling region
+    as a small unsigned integer array rather than the input itself.
     """
     N, C, H, W = x.shape
     pool_height, pool_width = pool_param['pool_height'], pool_param['pool_width']
@@ -183,41 +809,111 @@ def max_pool_forward_reshape(x, pool_param):
     assert pool_height == pool_width == stride, 'Invalid pool params'
     assert H % pool_height == 0
     assert W % pool_height == 0
-    x_reshaped = x.reshape(N, C, H // pool_height, pool_height,
-                           W // pool_width, pool_width)
-    out = x_reshaped.max(axis=3).max(axis=4)
-
-    cache = (x, x_reshaped, out)
+    out_h, out_w = H // pool_height, W // pool_width
+    area = pool_height * pool_width
+    x_reshaped = x.reshape(N, C, out_h, pool_height, out_w, pool_width)
+    windows = x_reshaped.transpose(0, 1, 2, 4, 3, 5).reshape(
+        N, C, out_h, out_w, area)
+    # argmax keeps the first maximum, in row-major order, on ties
+    offset = windows.argmax(axis=-1)
+    out = np.take_along_axis(windows, offset[..., None], axis=-1)[..., 0]
+    offset = offset.astype(np.uint8 if area <= 256 else np.uint16)
+
+    cache = (x.shape, pool_param, offset)
     return out, cache
 
 
 def max_pool_backward_reshape(dout, cache):
     """
     A fast implementation of the backward pass for the max pooling layer that
-    uses some clever broadcasting and reshaping.
+    routes each upstream derivative to the recorded winner of its region.
 
     This can only be used if the forward pass was computed using
     max_pool_forward_reshape.
 
-    NOTE: If there are multiple argmaxes, this method will assign gradient to
-    ALL argmax elements of the input rather than picking one. In this case the
-    gradient will actually be incorrect. However this is unlikely to occur in
-    practice, so it shouldn't matter much. One possible solution is to split the
-    upstream gradient equally among all argmax elements; this should result in a
-    valid subgradient. You can make this happen by uncommenting the line below;
-    however this results in a significant performance penalty (about 40% slower)
-    and is unlikely to matter in practice so we don't do it.
-    """
-    x, x_reshaped, out = cache
-
-    dx_reshaped = np.zeros_like(x_reshaped)
-    out_newaxis = out[:, :, :, np.newaxis, :, np.newaxis]
-    mask = (x_reshaped == out_newaxis)
-    dout_newaxis = dout[:, :, :, np.newaxis, :, np.newaxis]
-    dout_broadcast, _ = np.broadcast_arrays(dout_newaxis, dx_reshaped)
-    dx_reshaped[mask] = dout_broadcast[mask]
-    dx_reshaped /= np.sum(mask, axis=(3, 5), keepdims=True)
-    dx = dx_reshaped.reshape(x.shape)
+    If a region has several maximal elements, only the first one (in row-major
+    order) receives the gradient, which is a valid subgradient.
+    """
+    x_shape, pool_param, offset = cache
+    N, C, H, W = x_shape
+    pool_height, pool_width = pool_param['pool_height'], pool_param['pool_width']
+
+    dx_reshaped = np.empty((N, C, H // pool_height, pool_height,
+                            W // pool_width, pool_width), dtype=dout.dtype)
+    for k in range(pool_height * pool_width):
+        i, j = divmod(k, pool_width)
+        np.multiply(dout, offset == k, out=dx_reshaped[:, :, :, i, :, j])
+    dx = dx_reshaped.reshape(x_shape)
+
+    return dx
+
+
+def avg_pool_forward_fast(x, pool_param):
+    """
+    A fast implementation of the forward pass for an average pooling layer.
+
+    As with max pooling, square regions that tile the input use the reshape
+    method and everything else falls back on the strided window view.
+    """
+    N, C, H, W = x.shape
+    pool_height, pool_width = pool_param['pool_height'], pool_param['pool_width']
+    stride = pool_param['stride']
+
+    same_size = pool_height == pool_width == stride
+    tiles = H % pool_height == 0 and W % pool_width == 0
+    if same_size and tiles:
+        out, reshape_cache = avg_pool_forward_reshape(x, pool_param)
+        cache = ('reshape', reshape_cache)
+    else:
+        out, strided_cache = avg_pool_forward_naive(x, pool_param)
+        cache = ('strided', strided_cache)
+    return out, cache
+
+
+def avg_pool_backward_fast(dout, cache):
+    """
+    A fast implementation of the backward pass for an average pooling layer.
+    """
+    method, real_cache = cache
+    if method == 'reshape':
+        return avg_pool_backward_reshape(dout, real_cache)
+    elif method == 'strided':
+        return avg_pool_backward_naive(dout, real_cache)
+    else:
+        raise ValueError('Unrecognized method "%s"' % method)
+
+
+def avg_pool_forward_reshape(x, pool_param):
+    """
+    Forward pass for average pooling over square regions that tile the input.
+    """
+    N, C, H, W = x.shape
+    pool_height, pool_width = pool_param['pool_height'], pool_param['pool_width']
+    stride = pool_param['stride']
+    assert pool_height == pool_width == stride, 'Invalid pool params'
+    assert H % pool_height == 0
+    assert W % pool_height == 0
+    x_reshaped = x.reshape(N, C, H // pool_height, pool_height,
+                           W // pool_width, pool_width)
+    out = x_reshaped.mean(axis=(3, 5))
+
+    cache = (x.shape, pool_param)
+    return out, cache
+
+
+def avg_pool_backward_reshape(dout, cache):
+    """
+    Backward pass for average pooling computed by avg_pool_forward_reshape.
+    """
+    x_shape, pool_param = cache
+    N, C, H, W = x_shape
+    pool_height, pool_width = pool_param['pool_height'], pool_param['pool_width']
+
+    dout_share = dout / (pool_height * pool_width)
+    dx_reshaped = np.empty((N, C, H // pool_height, pool_height,
+                            W // pool_width, pool_width), dtype=dout_share.dtype)
+    dx_reshaped[...] = dout_share[:, :, :, None, :, None]
+    dx = dx_reshaped.reshape(x_shape)
 
     return dx
 
@@ -240,7 +936,8 @@ def max_pool_forward_im2col(x, pool_param):
     out_width = (W - pool_width) // stride + 1
 
     x_split = x.reshape(N * C, 1, H, W)
-    x_cols = im2col(x_split, pool_height, pool_width, padding=0, stride=stride)
+    x_cols = im2col_indices(x_split, pool_height, pool_width, padding=0,
+                            stride=stride)
     x_cols_argmax = np.argmax(x_cols, axis=0)
     x_cols_max = x_cols[x_cols_argmax, np.arange(x_cols.shape[1])]
     out = x_cols_max.reshape(out_height, out_width, N, C).transpose(2, 3, 0, 1)
@@ -1,14 +1,31 @@
 from builtins import range
+from functools import lru_cache
+
 import numpy as np
 
 
+# Index tensors only depend on the layer geometry, which is the same for
+# every minibatch, so the most recently used ones are kept around.
+IM2COL_INDEX_CACHE_SIZE = 32
+
+
 def get_im2col_indices(x_shape, field_height, field_width, padding=1, stride=1):
-    # First figure out what the size of the output should be
+    """
+    Returns read-only integer index arrays (k, i, j) such that
+    x_padded[:, k, i, j] gathers every receptive field of an input of shape
+    x_shape. Results are memoized; they do not depend on the batch size.
+    """
     N, C, H, W = x_shape
+    return _im2col_indices(C, H, W, field_height, field_width, padding, stride)
+
+
+@lru_cache(maxsize=IM2COL_INDEX_CACHE_SIZE)
+def _im2col_indices(C, H, W, field_height, field_width, padding, stride):
+    # First figure out what the size of the output should be
     assert (H + 2 * padding - field_height) % stride == 0
-    assert (W + 2 * padding - field_height) % stride == 0
-    out_height = (H + 2 * padding - field_height) / stride + 1
-    out_width = (W + 2 * padding - field_width) / stride + 1
+    assert (W + 2 * padding - field_width) % stride == 0
+    out_height = (H + 2 * padding - field_height) // stride + 1
+    out_width = (W + 2 * padding - field_width) // stride + 1
 
     i0 = np.repeat(np.arange(field_height), field_width)
     i0 = np.tile(i0, C)
@@ -20,6 +37,9 @@ def get_im2col_indices(x_shape, field_height, field_width, padding=1, stride=1):
 
     k = np.repeat(np.arange(C), field_height * field_width).reshape(-1, 1)
 
+    # The arrays are shared between callers, so guard them against writes
+    for index in (k, i, j):
+        index.flags.writeable = False
     return (k, i, j)
 
 
@@ -38,19 +58,64 @@ def im2col_indices(x, field_height, field_width, padding=1, stride=1):
     return cols
 
 
+def im2col_strides(x, field_height, field_width, padding=1, stride=1):
+    """
+    An implementation of im2col based on picking clever strides.
+
+    Returns cols of shape (C * field_height * field_width, N * out_h * out_w),
+    with columns ordered (n, out_row, out_col); col2im_6d_strided inverts it.
+    """
+    N, C, H, W = x.shape
+    p = padding
+    x_padded = np.pad(x, ((0, 0), (0, 0), (p, p), (p, p)), mode='constant')
+
+    H += 2 * padding
+    W += 2 * padding
+    out_h = (H - field_height) // stride + 1
+    out_w = (W - field_width) // stride + 1
+
+    shape = (C, field_height, field_width, N, out_h, out_w)
+    strides = (H * W, W, 1, C * H * W, stride * W, stride)
+    strides = x_padded.itemsize * np.array(strides)
+    x_stride = np.lib.stride_tricks.as_strided(x_padded,
+                  shape=shape, strides=strides)
+    cols = np.ascontiguousarray(x_stride)
+    cols.shape = (C * field_height * field_width, N * out_h * out_w)
+    return cols
+
+
 def col2im_indices(cols, x_shape, field_height=3, field_width=3, padding=1,
                    stride=1):
-    """ An implementation of col2im based on fancy indexing and np.add.at """
+    """ An implementation of col2im for the layout produced by im2col_indices """
     N, C, H, W = x_shape
-    H_padded, W_padded = H + 2 * padding, W + 2 * padding
-    x_padded = np.zeros((N, C, H_padded, W_padded), dtype=cols.dtype)
-    k, i, j = get_im2col_indices(x_shape, field_height, field_width, padding,
-                                 stride)
-    cols_reshaped = cols.reshape(C * field_height * field_width, -1, N)
-    cols_reshaped = cols_reshaped.transpose(2, 0, 1)
-    np.add.at(x_padded, (slice(None), k, i, j), cols_reshaped)
-    if padding == 0:
-        return x_padded
-    return x_padded[:, :, padding:-padding, padding:-padding]
+    out_height = (H + 2 * padding - field_height) // stride + 1
+    out_width = (W + 2 * padding - field_width) // stride + 1
+    # Columns are ordered (out_row, out_col, n) with n fastest
+    cols_6d = cols.reshape(C, field_height, field_width, out_height, out_width,
+                           N).transpose(0, 1, 2, 5, 3, 4)
+    return col2im_6d_strided(cols_6d, N, C, H, W, field_height, field_width,
+                             padding, stride)
+
+
+def col2im_6d_strided(cols, N, C, H, W, HH, WW, pad, stride):
+    """
+    An implementation of col2im that needs neither np.add.at nor Cython.
+
+    cols has shape (C, HH, WW, N, out_h, out_w), as in col2im_6d_cython. For
+    each of the HH * WW kernel offsets, the whole (C, N, out_h, out_w) block of
+    gradients lands on a strided slice of the padded input, so it is added
+    with one vectorized operation rather than one scalar add per element.
+    """
+    out_h = (H + 2 * pad - HH) // stride + 1
+    out_w = (W + 2 * pad - WW) // stride + 1
+    # Accumulate in (C, N, H, W) order so every add reads cols contiguously
+    x_padded = np.zeros((C, N, H + 2 * pad, W + 2 * pad), dtype=cols.dtype)
+    cols = cols.reshape(C, HH, WW, N, out_h, out_w)
+    for hh in range(HH):
+        for ww in range(WW):
+            x_padded[:, :, hh:hh + stride * out_h:stride,
+                     ww:ww + stride * out_w:stride] += cols[:, hh, ww]
+    x = x_padded[:, :, pad:pad + H, pad:pad + W].transpose(1, 0, 2, 3)
+    return np.ascontiguousarray(x)
 
 pass
@@ -1,6 +1,10 @@
+# cython: language_level=3
+import multiprocessing
+
 import numpy as np
 cimport numpy as np
 cimport cython
+from cython.parallel cimport prange
 
 # DTYPE = np.float64
 # ctypedef np.float64_t DTYPE_t
@@ -9,62 +13,78 @@ ctypedef fused DTYPE_t:
     np.float32_t
     np.float64_t
 
-def im2col_cython(np.ndarray[DTYPE_t, ndim=4] x, int field_height,
+# Number of OpenMP threads used by the kernels below. Each kernel splits its
+# work over channels, and different channels write disjoint outputs.
+cdef int num_threads = multiprocessing.cpu_count()
+
+
+def set_num_threads(int n):
+    """ Sets the number of threads used by the im2col / col2im kernels. """
+    global num_threads
+    if n < 1:
+        raise ValueError('Invalid number of threads %d' % n)
+    num_threads = n
+
+
+def get_num_threads():
+    return num_threads
+
+
+def im2col_cython(DTYPE_t[:, :, :, :] x, int field_height,
                   int field_width, int padding, int stride):
     cdef int N = x.shape[0]
     cdef int C = x.shape[1]
     cdef int H = x.shape[2]
     cdef int W = x.shape[3]
-    
-    cdef int HH = (H + 2 * padding - field_height) / stride + 1
-    cdef int WW = (W + 2 * padding - field_width) / stride + 1
-
-    cdef int p = padding
-    cdef np.ndarray[DTYPE_t, ndim=4] x_padded = np.pad(x,
-            ((0, 0), (0, 0), (p, p), (p, p)), mode='constant')
-
-    cdef np.ndarray[DTYPE_t, ndim=2] cols = np.zeros(
-            (C * field_height * field_width, N * HH * WW),
-            dtype=x.dtype)
 
-    # Moving the inner loop to a C function with no bounds checking works, but does
-    # not seem to help performance in any measurable way.
+    cdef int HH = (H + 2 * padding - field_height) // stride + 1
+    cdef int WW = (W + 2 * padding - field_width) // stride + 1
 
-    im2col_cython_inner(cols, x_padded, N, C, H, W, HH, WW,
+    cdef int p = padding
+    x_padded = np.pad(np.asarray(x), ((0, 0), (0, 0), (p, p), (p, p)),
+                      mode='constant')
+    cols = np.empty((C * field_height * field_width, N * HH * WW),
+                    dtype=x_padded.dtype)
+
+    cdef DTYPE_t[:, ::1] cols_view = cols
+    cdef DTYPE_t[:, :, :, ::1] x_padded_view = x_padded
+    im2col_cython_inner(cols_view, x_padded_view, N, C, H, W, HH, WW,
                         field_height, field_width, padding, stride)
     return cols
 
 
 @cython.boundscheck(False)
-cdef int im2col_cython_inner(np.ndarray[DTYPE_t, ndim=2] cols,
-                             np.ndarray[DTYPE_t, ndim=4] x_padded,
-                             int N, int C, int H, int W, int HH, int WW,
-                             int field_height, int field_width, int padding, int stride) except? -1:
-    cdef int c, ii, jj, row, yy, xx, i, col
-
-    for c in range(C):
-        for yy in range(HH):
-            for xx in range(WW):
-                for ii in range(field_height):
-                    for jj in range(field_width):
-                        row = c * field_width * field_height + ii * field_height + jj
-                        for i in range(N):
-                            col = yy * WW * N + xx * N + i
-                            cols[row, col] = x_padded[i, c, stride * yy + ii, stride * xx + jj]
+@cython.wraparound(False)
+cdef void im2col_cython_inner(DTYPE_t[:, ::1] cols,
+                              DTYPE_t[:, :, :, ::1] x_padded,
+                              int N, int C, int H, int W, int HH, int WW,
+                              int field_height, int field_width, int padding,
+                              int stride) nogil:
+    cdef int c, ii, jj, row, yy, xx, i
+
+    # The output column index is yy * WW * N + xx * N + i; walking xx in the
+    # innermost loop keeps the reads from each input row sequential.
+    for c in prange(C, num_threads=num_threads, schedule='static'):
+        for ii in range(field_height):
+            for jj in range(field_width):
+                row = c * field_width * field_height + ii * field_width + jj
+                for i in range(N):
+                    for yy in range(HH):
+                        for xx in range(WW):
+                            cols[row, yy * WW * N + xx * N + i] = \
+                                x_padded[i, c, stride * yy + ii, stride * xx + jj]
 
 
 
-def col2im_cython(np.ndarray[DTYPE_t, ndim=2] cols, int N, int C, int H, int W,
+def col2im_cython(DTYPE_t[:, ::1] cols, int N, int C, int H, int W,
                   int field_height, int field_width, int padding, int stride):
-    cdef np.ndarray x = np.empty((N, C, H, W), dtype=cols.dtype)
-    cdef int HH = (H + 2 * padding - field_height) / stride + 1
-    cdef int WW = (W + 2 * padding - field_width) / stride + 1
-    cdef np.ndarray[DTYPE_t, ndim=4] x_padded = np.zeros((N, C, H + 2 * padding, W + 2 * padding),
-                                        dtype=cols.dtype)
-
-    # Moving the inner loop to a C-function with no bounds checking improves
-    # performance quite a bit for col2im.
-    col2im_cython_inner(cols, x_padded, N, C, H, W, HH, WW, 
+    cdef int HH = (H + 2 * padding - field_height) // stride + 1
+    cdef int WW = (W + 2 * padding - field_width) // stride + 1
+    x_padded = np.zeros((N, C, H + 2 * padding, W + 2 * padding),
+                        dtype=np.asarray(cols).dtype)
+
+    cdef DTYPE_t[:, :, :, ::1] x_padded_view = x_padded
+    col2im_cython_inner(cols, x_padded_view, N, C, H, W, HH, WW,
                         field_height, field_width, padding, stride)
     if padding > 0:
         return x_padded[:, :, padding:-padding, padding:-padding]
@@ -72,50 +92,54 @@ def col2im_cython(np.ndarray[DTYPE_t, ndim=2] cols, int N, int C, int H, int W,
 
 
 @cython.boundscheck(False)
-cdef int col2im_cython_inner(np.ndarray[DTYPE_t, ndim=2] cols,
-                             np.ndarray[DTYPE_t, ndim=4] x_padded,
-                             int N, int C, int H, int W, int HH, int WW,
-                             int field_height, int field_width, int padding, int stride) except? -1:
-    cdef int c, ii, jj, row, yy, xx, i, col
-
-    for c in range(C):
+@cython.wraparound(False)
+cdef void col2im_cython_inner(DTYPE_t[:, ::1] cols,
+                              DTYPE_t[:, :, :, ::1] x_padded,
+                              int N, int C, int H, int W, int HH, int WW,
+                              int field_height, int field_width, int padding,
+                              int stride) nogil:
+    cdef int c, ii, jj, row, yy, xx, i
+
+    for c in prange(C, num_threads=num_threads, schedule='static'):
         for ii in range(field_height):
             for jj in range(field_width):
-                row = c * field_width * field_height + ii * field_height + jj
-                for yy in range(HH):
-                    for xx in range(WW):
-                        for i in range(N):
-                            col = yy * WW * N + xx * N + i
-                            x_padded[i, c, stride * yy + ii, stride * xx + jj] += cols[row, col]
+                row = c * field_width * field_height + ii * field_width + jj
+                for i in range(N):
+                    for yy in range(HH):
+                        for xx in range(WW):
+                            x_padded[i, c, stride * yy + ii, stride * xx + jj] += \
+                                cols[row, yy * WW * N + xx * N + i]
 
 
 @cython.boundscheck(False)
 @cython.wraparound(False)
-cdef col2im_6d_cython_inner(np.ndarray[DTYPE_t, ndim=6] cols,
-                            np.ndarray[DTYPE_t, ndim=4] x_padded,
-                            int N, int C, int H, int W, int HH, int WW,
-                            int out_h, int out_w, int pad, int stride):
+cdef void col2im_6d_cython_inner(DTYPE_t[:, :, :, :, :, ::1] cols,
+                                 DTYPE_t[:, :, :, ::1] x_padded,
+                                 int N, int C, int H, int W, int HH, int WW,
+                                 int out_h, int out_w, int pad, int stride) nogil:
 
     cdef int c, hh, ww, n, h, w
-    for n in range(N):
-        for c in range(C):
+    # Both arrays are walked with their last axis innermost
+    for c in prange(C, num_threads=num_threads, schedule='static'):
+        for n in range(N):
             for hh in range(HH):
                 for ww in range(WW):
                     for h in range(out_h):
                         for w in range(out_w):
                             x_padded[n, c, stride * h + hh, stride * w + ww] += cols[c, hh, ww, n, h, w]
-    
 
-def col2im_6d_cython(np.ndarray[DTYPE_t, ndim=6] cols, int N, int C, int H, int W,
+
+def col2im_6d_cython(DTYPE_t[:, :, :, :, :, ::1] cols, int N, int C, int H, int W,
         int HH, int WW, int pad, int stride):
-    cdef np.ndarray x = np.empty((N, C, H, W), dtype=cols.dtype)
-    cdef int out_h = (H + 2 * pad - HH) / stride + 1
-    cdef int out_w = (W + 2 * pad - WW) / stride + 1
-    cdef np.ndarray[DTYPE_t, ndim=4] x_padded = np.zeros((N, C, H + 2 * pad, W + 2 * pad),
-                                                  dtype=cols.dtype)
+    cdef int out_h = (H + 2 * pad - HH) // stride + 1
+    cdef int out_w = (W + 2 * pad - WW) // stride + 1
+    x_padded = np.zeros((N, C, H + 2 * pad, W + 2 * pad),
+                        dtype=np.asarray(cols).dtype)
 
-    col2im_6d_cython_inner(cols, x_padded, N, C, H, W, HH, WW, out_h, out_w, pad, stride)
+    cdef DTYPE_t[:, :, :, ::1] x_padded_view = x_padded
+    col2im_6d_cython_inner(cols, x_padded_view, N, C, H, W,
+                           HH, WW, out_h, out_w, pad, stride)
 
     if pad > 0:
         return x_padded[:, :, pad:-pad, pad:-pad]
-    return x_padded 
+    return x_padded
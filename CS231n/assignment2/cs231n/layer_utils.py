@@ -15,8 +15,13 @@ def affine_relu_forward(x, w, b):
     - out: Output from the ReLU
     - cache: Object to give to the backward pass
     """
-    a, fc_cache = affine_forward(x, w, b)
-    out, relu_cache = relu_forward(a)
+    # The product is written straight into the output buffer, which then
+    # gets the bias and the ReLU in place
+    out = np.empty((x.shape[0], w.shape[1]), dtype=np.result_type(x, w))
+    np.matmul(x.reshape(x.shape[0], -1), w, out=out)
+    out += b
+    out, relu_cache = relu_forward(out, out=out)
+    fc_cache = (x, w, b)
     cache = (fc_cache, relu_cache)
     return out, cache
 
@@ -141,14 +146,31 @@ def conv_relu_backward(dout, cache):
 
 
 def conv_bn_relu_forward(x, w, b, gamma, beta, conv_param, bn_param):
+    """
+    Convenience layer that performs a convolution, a spatial batch
+    normalization, and a ReLU. The batchnorm works on the NCHW conv output
+    without transposing it, and the ReLU is applied in place on its output.
+
+    Inputs:
+    - x: Input to the convolutional layer
+    - w, b, conv_param: Weights and parameters for the convolutional layer
+    - gamma, beta, bn_param: Parameters for the spatial batchnorm layer
+
+    Returns a tuple of:
+    - out: Output from the ReLU
+    - cache: Object to give to the backward pass
+    """
     a, conv_cache = conv_forward_fast(x, w, b, conv_param)
     an, bn_cache = spatial_batchnorm_forward(a, gamma, beta, bn_param)
-    out, relu_cache = relu_forward(an)
+    out, relu_cache = relu_forward(an, out=an)
     cache = (conv_cache, bn_cache, relu_cache)
     return out, cache
 
 
 def conv_bn_relu_backward(dout, cache):
+    """
+    Backward pass for the conv-bn-relu convenience layer.
+    """
     conv_cache, bn_cache, relu_cache = cache
     dan = relu_backward(dout, relu_cache)
     da, dgamma, dbeta = spatial_batchnorm_backward(dan, bn_cache)
@@ -160,6 +182,11 @@ def conv_relu_pool_forward(x, w, b, conv_param, pool_param):
     """
     Convenience layer that performs a convolution, a ReLU, and a pool.
 
+    The ReLU is applied in place on the convolution output, which is then
+    pooled directly and released. A pooled value is positive exactly when the
+    winner of its region was positive before the ReLU, so the only ReLU state
+    kept for the backward pass is a bitmask of the pooled output.
+
     Inputs:
     - x: Input to the convolutional layer
     - w, b, conv_param: Weights and parameters for the convolutional layer
@@ -170,9 +197,10 @@ def conv_relu_pool_forward(x, w, b, conv_param, pool_param):
     - cache: Object to give to the backward pass
     """
     a, conv_cache = conv_forward_fast(x, w, b, conv_param)
-    s, relu_cache = relu_forward(a)
-    out, pool_cache = max_pool_forward_fast(s, pool_param)
-    cache = (conv_cache, relu_cache, pool_cache)
+    np.maximum(a, 0, out=a)
+    out, pool_cache = max_pool_forward_fast(a, pool_param)
+    relu_mask = np.packbits(out > 0)
+    cache = (conv_cache, relu_mask, pool_cache)
     return out, cache
 
 
@@ -180,8 +208,71 @@ def conv_relu_pool_backward(dout, cache):
     """
     Backward pass for the conv-relu-pool convenience layer
     """
+    conv_cache, relu_mask, pool_cache = cache
+    mask = np.unpackbits(relu_mask, count=dout.size).reshape(dout.shape)
+    ds = max_pool_backward_fast(dout * mask, pool_cache)
+    dx, dw, db = conv_backward_fast(ds, conv_cache)
+    return dx, dw, db
+
+
+def conv_relu_avg_pool_forward(x, w, b, conv_param, pool_param):
+    """
+    Convenience layer that performs a convolution, a ReLU, and an average pool.
+
+    Inputs:
+    - x: Input to the convolutional layer
+    - w, b, conv_param: Weights and parameters for the convolutional layer
+    - pool_param: Parameters for the pooling layer
+
+    Returns a tuple of:
+    - out: Output from the pooling layer
+    - cache: Object to give to the backward pass
+    """
+    a, conv_cache = conv_forward_fast(x, w, b, conv_param)
+    s, relu_cache = relu_forward(a)
+    out, pool_cache = avg_pool_forward_fast(s, pool_param)
+    cache = (conv_cache, relu_cache, pool_cache)
+    return out, cache
+
+
+def conv_relu_avg_pool_backward(dout, cache):
+    """
+    Backward pass for the conv-relu-avg_pool convenience layer
+    """
+    conv_cache, relu_cache, pool_cache = cache
+    ds = avg_pool_backward_fast(dout, pool_cache)
+    da = relu_backward(ds, relu_cache)
+    dx, dw, db = conv_backward_fast(da, conv_cache)
+    return dx, dw, db
+
+
+def conv_relu_global_pool_forward(x, w, b, conv_param):
+    """
+    Convenience layer that performs a convolution, a ReLU, and a global
+    average pool, producing one feature per filter. This can stand in for a
+    large affine layer on top of the final feature map.
+
+    Inputs:
+    - x: Input to the convolutional layer
+    - w, b, conv_param: Weights and parameters for the convolutional layer
+
+    Returns a tuple of:
+    - out: Output from the pooling layer, of shape (N, F)
+    - cache: Object to give to the backward pass
+    """
+    a, conv_cache = conv_forward_fast(x, w, b, conv_param)
+    s, relu_cache = relu_forward(a)
+    out, pool_cache = global_avg_pool_forward(s)
+    cache = (conv_cache, relu_cache, pool_cache)
+    return out, cache
+
+
+def conv_relu_global_pool_backward(dout, cache):
+    """
+    Backward pass for the conv-relu-global_pool convenience layer
+    """
     conv_cache, relu_cache, pool_cache = cache
-    ds = max_pool_backward_fast(dout, pool_cache)
+    ds = global_avg_pool_backward(dout, pool_cache)
     da = relu_backward(ds, relu_cache)
     dx, dw, db = conv_backward_fast(da, conv_cache)
     return dx, dw, db
@@ -59,11 +59,10 @@ def affine_backward(dout, cache):
     
     N = x.shape[0]
     flatten_x = x.reshape(N,-1)
-    xw = flatten_x.dot(w)
     
     # xw + b
     dxw = dout
-    db = np.ones(N).dot(dout)
+    db = dout.sum(axis=0)
     
     # x.dot(w)
     dx = dxw.dot(w.T).reshape(x.shape)
@@ -76,29 +75,30 @@ def affine_backward(dout, cache):
     return dx, dw, db
 
 
-def relu_forward(x):
+def relu_forward(x, out=None):
     """
     Computes the forward pass for a layer of rectified linear units (ReLUs).
 
     Input:
     - x: Inputs, of any shape
+    - out: Optional array to write the output to. Passing x itself applies
+      the ReLU in place.
 
     Returns a tuple of:
     - out: Output, of the same shape as x
-    - cache: x
+    - cache: (mask, shape) where mask is the bit-packed boolean array x > 0
     """
-    out = None
     ###########################################################################
     # TODO: Implement the ReLU forward pass.                                  #
     ###########################################################################
-    
-    out = np.maximum(0,x)
-    
-    #pass
+
+    mask = np.packbits(x > 0)
+    out = np.maximum(x, 0, out=out)
+
     ###########################################################################
     #                             END OF YOUR CODE                            #
     ###########################################################################
-    cache = x
+    cache = (mask, x.shape)
     return out, cache
 
 
@@ -108,18 +108,19 @@ def relu_backward(dout, cache):
 
     Input:
     - dout: Upstream derivatives, of any shape
-    - cache: Input x, of same shape as dout
+    - cache: (mask, shape) as returned by relu_forward
 
     Returns:
-    - dx: Gradient with respect to x
+    - dx: Gradient with respect to x. This is a new array; dout is left as is.
     """
-    dx, x = None, cache
+    dx, (mask, shape) = None, cache
     ###########################################################################
     # TODO: Implement the ReLU backward pass.                                 #
     ###########################################################################
-    dx = dout
-    dx[x<0] = 0
-    #pass
+
+    mask = np.unpackbits(mask, count=dout.size).reshape(shape)
+    dx = dout * mask
+
     ###########################################################################
     #                             END OF YOUR CODE                            #
     ###########################################################################
@@ -316,6 +317,101 @@ def batchnorm_backward_alt(dout, cache):
 
     return dx, dgamma, dbeta
 
+def batchnorm_forward_fused(x, gamma, beta, bn_param):
+    """
+    Forward pass for batch normalization that keeps a minimal cache.
+
+    Same inputs, outputs and bn_param handling as batchnorm_forward. In train
+    mode the data is centered once; the variance is reduced from the centered
+    data without materializing its square, and the centered data is then
+    scaled in place to give x_hat. The cache holds only (x_hat, gamma,
+    inv_std), which is all that batchnorm_backward_fused needs.
+    """
+    mode = bn_param['mode']
+    eps = bn_param.get('eps', 1e-5)
+    momentum = bn_param.get('momentum', 0.9)
+
+    N, D = x.shape
+    running_mean = bn_param.get('running_mean', np.zeros(D, dtype=x.dtype))
+    running_var = bn_param.get('running_var', np.zeros(D, dtype=x.dtype))
+
+    out, cache = None, None
+    if mode == 'train':
+        mean = x.mean(axis=0)
+        x_hat = x - mean
+        var = np.einsum('nd,nd->d', x_hat, x_hat) / N
+        inv_std = 1.0 / np.sqrt(var + eps)
+        x_hat *= inv_std
+        out = x_hat * gamma
+        out += beta
+
+        running_mean = momentum * running_mean + (1 - momentum) * mean
+        running_var = momentum * running_var + (1 - momentum) * var
+        cache = (x_hat, gamma, inv_std)
+    elif mode == 'test':
+        scale = gamma / np.sqrt(running_var + eps)
+        out = x * scale
+        out += beta - running_mean * scale
+    else:
+        raise ValueError('Invalid forward batchnorm mode "%s"' % mode)
+
+    bn_param['running_mean'] = running_mean
+    bn_param['running_var'] = running_var
+
+    return out, cache
+
+
+def batchnorm_backward_fused(dout, cache):
+    """
+    Backward pass for batchnorm_forward_fused.
+
+    Uses the simplified expression of batchnorm_backward_alt, which needs one
+    reduction for dbeta and one for dgamma; dx is built from those two.
+
+    Inputs / outputs: Same as batchnorm_backward
+    """
+    x_hat, gamma, inv_std = cache
+    N = dout.shape[0]
+    dbeta = dout.sum(axis=0)
+    dgamma = np.einsum('nd,nd->d', dout, x_hat)
+    dx = x_hat * dgamma
+    dx += dbeta
+    np.subtract(N * dout, dx, out=dx)
+    dx *= gamma * inv_std / N
+    return dx, dgamma, dbeta
+
+
+def fold_batchnorm(w, b, gamma, beta, bn_param):
+    """
+    Folds a test-mode batch normalization layer into the affine or conv layer
+    that feeds it, so that layer alone computes batchnorm(layer(x)).
+
+    Inputs:
+    - w: Weights of the preceding layer, of shape (D, M) for an affine layer
+      or (F, C, HH, WW) for a conv layer
+    - b: Biases of the preceding layer, of shape (M,) or (F,)
+    - gamma, beta: Scale and shift parameters of the batchnorm layer
+    - bn_param: The batchnorm layer's bn_param, holding its running_mean,
+      running_var and optionally eps
+
+    Returns a tuple of:
+    - w_folded: Folded weights, of the same shape as w
+    - b_folded: Folded biases, of the same shape as b
+    """
+    eps = bn_param.get('eps', 1e-5)
+    running_mean = bn_param.get('running_mean', np.zeros_like(gamma))
+    running_var = bn_param.get('running_var', np.zeros_like(gamma))
+    scale = gamma / np.sqrt(running_var + eps)
+    if w.ndim == 4:
+        w_folded = w * scale[:, None, None, None]
+    elif w.ndim == 2:
+        w_folded = w * scale
+    else:
+        raise ValueError('Invalid weight shape "%s"' % (w.shape,))
+    b_folded = (b - running_mean) * scale + beta
+    return w_folded.astype(w.dtype), b_folded.astype(b.dtype)
+
+
 def layernorm_forward(x, gamma, beta, ln_param):
     """
     Forward pass for layer normalization.
@@ -352,15 +448,17 @@ def layernorm_forward(x, gamma, beta, ln_param):
     ###########################################################################
     # *****START OF YOUR CODE (DO NOT DELETE/MODIFY THIS LINE)*****
 
-    x = x.T  # transfer x from (N, D) to (D, N)
-    
-    mean_batch = x.mean(axis=0)
-    var_batch = x.var(axis=0)
-        
-    x_center = x - mean_batch
-    x_norm = x_center / np.sqrt(var_batch + eps)
-    out = x_norm.T*gamma + beta                           # note that `beta` is added to features
-    cache = (x_center, x_norm, var_batch, gamma, eps)
+    # Each row is normalized with its own statistics, so every reduction
+    # runs along axis 1 and the cache only keeps x_hat and 1 / std per row
+    D = x.shape[1]
+    mean = x.mean(axis=1, keepdims=True)
+    x_hat = x - mean
+    var = np.einsum('nd,nd->n', x_hat, x_hat) / D
+    inv_std = 1.0 / np.sqrt(var + eps)
+    x_hat *= inv_std[:, None]
+    out = x_hat * gamma
+    out += beta
+    cache = (x_hat, gamma, inv_std)
     
     #pass
 
@@ -397,23 +495,18 @@ def layernorm_backward(dout, cache):
     ###########################################################################
     # *****START OF YOUR CODE (DO NOT DELETE/MODIFY THIS LINE)*****
 
-    # Unpack the cache
-    x_center, x_norm, var_batch, gamma, eps = cache
-    dout = dout.T                                        # transfer shape of `dout` from (N, D) to (D, N), 
-                                                         # so that I hardly need to modify the computation of gradients !
-                                                         # all I need to do is just to fit the dimensions of `dx`, `dgamma` and `dbeta`
-    N, D = dout.shape
-    
-    
-    var_batch += eps
-    dx_norm = (dout.T * gamma).T                         # fit 1: transpose is just to fit usage of broadcast in numpy
-    dvar_batch = (-0.5) * dx_norm.T.dot(x_norm/var_batch).diagonal()
-    dx_center = (2.0/N) * x_center * dvar_batch + dx_norm / np.sqrt(var_batch)
-    dmean_batch = np.ones((D, N)).dot(-1.0 * dx_center).diagonal()
-    
-    dx = (dx_center + (1.0/N) * dmean_batch).T           # fit 2: should return in shape (N, D)
-    dgamma = x_norm.dot(dout.T).diagonal()               # fit 3: exchange the position of two array to fit the dimension
-    dbeta = dout.dot(np.ones(D))                         #        (compared to code in batchnorm_backward())
+    x_hat, gamma, inv_std = cache
+    D = dout.shape[1]
+    dbeta = dout.sum(axis=0)
+    dgamma = np.einsum('nd,nd->d', dout, x_hat)
+
+    # Same simplified expression as batchnorm_backward_alt, with the sums
+    # taken over the features of each row instead of over the batch
+    dx_hat = dout * gamma
+    dx = x_hat * np.einsum('nd,nd->n', dx_hat, x_hat)[:, None]
+    dx += dx_hat.sum(axis=1, keepdims=True)
+    np.subtract(D * dx_hat, dx, out=dx)
+    dx *= inv_std[:, None] / D
 
     #pass
 
@@ -425,6 +518,24 @@ def layernorm_backward(dout, cache):
 
 
 
+def _dropout_generator(seed, step, layer):
+    """
+    Returns a counter-based generator for one dropout layer at one step.
+
+    The Philox key is built from (seed, layer) and the step is written into
+    the high words of the counter, so each (seed, step, layer) selects its own
+    stream directly, without drawing through the ones before it.
+    """
+    key = (seed % 2 ** 64) | (layer % 2 ** 64) << 64
+    counter = (step % 2 ** 128) << 128
+    return np.random.Generator(np.random.Philox(key=key, counter=counter))
+
+
+def _dropout_mask(shape, p, seed, step, layer):
+    rng = _dropout_generator(seed, step, layer)
+    return rng.random(shape, dtype=np.float32) < p
+
+
 def dropout_forward(x, dropout_param):
     """
     Performs the forward pass for (inverted) dropout.
@@ -437,16 +548,32 @@ def dropout_forward(x, dropout_param):
         if the mode is test, then just return the input.
       - seed: Seed for the random number generator. Passing seed makes this
         function deterministic, which is needed for gradient checking but not
-        in real networks.
+        in real networks. If omitted, a seed is drawn from the global numpy
+        RNG on every call, so np.random.seed still makes runs reproducible.
+      - layer: Optional index of the dropout layer (default 0); layers that
+        share a seed draw different masks.
+      - step: Optional training step (default 0); with a fixed seed, each step
+        draws a different mask.
+      - regenerate: If True, the mask is not cached but drawn again in the
+        backward pass from (seed, step, layer).
+
+    Mask bits come from a Philox generator keyed on (seed, step, layer), so
+    the global numpy RNG is never reseeded, and is only consumed to draw a
+    missing seed.
 
     Outputs:
     - out: Array of the same shape as x.
-    - cache: tuple (dropout_param, mask). In training mode, mask is the dropout
-      mask that was used to multiply the input; in test mode, mask is None.
+    - cache: tuple (dropout_param, mask, key, shape). In training mode, mask
+      is the bit-packed dropout mask that was used to multiply the input, or
+      None if it is regenerated; in test mode, mask is None. key is the
+      (seed, step, layer) the mask was drawn from.
     """
     p, mode = dropout_param['p'], dropout_param['mode']
     if 'seed' in dropout_param:
-        np.random.seed(dropout_param['seed'])
+        seed = dropout_param['seed']
+    else:
+        seed = int(np.random.randint(np.iinfo(np.int64).max, dtype=np.int64))
+    key = (seed, dropout_param.get('step', 0), dropout_param.get('layer', 0))
 
     mask = None
     out = None
@@ -456,8 +583,10 @@ def dropout_forward(x, dropout_param):
         # TODO: Implement training phase forward pass for inverted dropout.   #
         # Store the dropout mask in the mask variable.                        #
         #######################################################################
-        mask = (np.random.random(x.shape) < p) 
-        out = x * mask
+        keep = _dropout_mask(x.shape, p, *key)
+        out = x * keep
+        if not dropout_param.get('regenerate', False):
+            mask = np.packbits(keep)
         #pass
         #######################################################################
         #                           END OF YOUR CODE                          #
@@ -472,7 +601,7 @@ def dropout_forward(x, dropout_param):
         #                            END OF YOUR CODE                         #
         #######################################################################
 
-    cache = (dropout_param, mask)
+    cache = (dropout_param, mask, key, x.shape)
     out = out.astype(x.dtype, copy=False)
 
     return out, cache
@@ -484,9 +613,9 @@ def dropout_backward(dout, cache):
 
     Inputs:
     - dout: Upstream derivatives, of any shape
-    - cache: (dropout_param, mask) from dropout_forward.
+    - cache: (dropout_param, mask, key, shape) from dropout_forward.
     """
-    dropout_param, mask = cache
+    dropout_param, mask, key, shape = cache
     mode = dropout_param['mode']
 
     dx = None
@@ -494,7 +623,11 @@ def dropout_backward(dout, cache):
         #######################################################################
         # TODO: Implement training phase backward pass for inverted dropout   #
         #######################################################################
-        dx = dout * mask
+        if mask is None:
+            keep = _dropout_mask(shape, dropout_param['p'], *key)
+        else:
+            keep = np.unpackbits(mask, count=dout.size).reshape(shape)
+        dx = dout * keep
         #pass
         #######################################################################
         #                          END OF YOUR CODE                           #
@@ -520,6 +653,8 @@ def conv_forward_naive(x, w, b, conv_param):
       - 'stride': The number of pixels between adjacent receptive fields in the
         horizontal and vertical directions.
       - 'pad': The number of pixels that will be used to zero-pad the input.
+      - 'method': Optional; 'naive' (default) runs the reference loops below,
+        'vectorized' dispatches to conv_forward_vectorized.
 
     Returns a tuple of:
     - out: Output data, of shape (N, F, H', W') where H' and W' are given by
@@ -532,18 +667,24 @@ def conv_forward_naive(x, w, b, conv_param):
     # TODO: Implement the convolutional forward pass.                         #
     # Hint: you can use the function np.pad for padding.                      #
     ###########################################################################
-    
+
+    method = conv_param.get('method', 'naive')
+    if method == 'vectorized':
+        return conv_forward_vectorized(x, w, b, conv_param)
+    elif method != 'naive':
+        raise ValueError('Invalid conv method "%s"' % method)
+
     stride, pad = conv_param['stride'], conv_param['pad']
     N, C, H, W = x.shape
     F, C, HH, WW = w.shape
     #padding
     Pad_W, Pad_H = W + 2 * pad, H + 2 * pad
     Pad_shape = (N, C, Pad_H, Pad_W)
-    Pad_x = np.zeros(Pad_shape)
+    Pad_x = np.zeros(Pad_shape, dtype=x.dtype)
     for i in range(N):
         for j in range(C):
             img = x[i, j]
-            Padding_img = np.zeros((Pad_H, Pad_W))
+            Padding_img = np.zeros((Pad_H, Pad_W), dtype=x.dtype)
             Padding_img[pad:-pad, pad:-pad] = img
             Pad_x[i, j] = Padding_img
     #stride
@@ -554,7 +695,7 @@ def conv_forward_naive(x, w, b, conv_param):
         for f in range(F):
             temp_data = None
             for row in range(H_):
-                temp = np.array([])
+                temp = np.array([], dtype=np.result_type(x, w, b))
                 for col in range(W_):
                     temp = np.append(temp, np.sum(Pad_x[i, :, stride*row: stride*row+HH, stride*col: stride*col+WW]*w[f])+b[f])
                 temp = temp[np.newaxis, :]
@@ -600,16 +741,17 @@ def conv_backward_naive(dout, cache):
     ###########################################################################
     
     x, w, b, conv_param = cache
+    if conv_param.get('method', 'naive') == 'vectorized':
+        return conv_backward_vectorized(dout, cache)
+
     stride, pad = conv_param['stride'], conv_param['pad']
     N, C, H, W = x.shape
     F, C, HH, WW = w.shape
     H_ = int(1 + (H + 2 * pad - HH) / stride)
     W_ = int(1 + (W + 2 * pad - WW) / stride)
-    dx = np.zeros(x.shape)
-    dw = np.zeros(w.shape)
-    db = np.zeros(b.shape)
+    dw = np.zeros(w.shape, dtype=np.result_type(dout, x))
     x_=np.pad(x,((0,0),(0,0),(pad,pad),(pad,pad)),'constant')
-    dx_ = np.zeros(x_.shape)
+    dx_ = np.zeros(x_.shape, dtype=np.result_type(dout, w))
     db = np.sum(dout, axis=0).sum(axis=1).sum(axis=1) #shape (F, )
     for i in range(N):
         for f in range(F):
@@ -617,8 +759,7 @@ def conv_backward_naive(dout, cache):
                 for col in range(W_):
                     dw[f] += x_[i, :, stride*row: stride*row+HH, stride*col: stride*col+WW] * dout[i, f, row, col]
                     dx_[i, :, stride*row: stride*row+HH, stride*col: stride*col+WW] += w[f] * dout[i, f, row, col]
-    dx=np.delete(dx_,[0,-1],axis=-1)
-    dx=np.delete(dx,[0,-1],axis=2)
+    dx = dx_[:, :, pad:pad + H, pad:pad + W]
     
     #pass
     ###########################################################################
@@ -627,6 +768,83 @@ def conv_backward_naive(dout, cache):
     return dx, dw, db
 
 
+def _window_view(x_padded, HH, WW, stride):
+    """
+    Returns a zero-copy view of shape (N, C, H', W', HH, WW) over a padded
+    input, where view[n, c, i, j] is the HH x WW window feeding output
+    position (i, j). The view aliases x_padded and must not be written to.
+    """
+    N, C, H, W = x_padded.shape
+    out_h = (H - HH) // stride + 1
+    out_w = (W - WW) // stride + 1
+    s0, s1, s2, s3 = x_padded.strides
+    shape = (N, C, out_h, out_w, HH, WW)
+    strides = (s0, s1, stride * s2, stride * s3, s2, s3)
+    return np.lib.stride_tricks.as_strided(x_padded, shape=shape,
+                                           strides=strides)
+
+
+def conv_forward_vectorized(x, w, b, conv_param):
+    """
+    A vectorized implementation of the forward pass for a convolutional layer.
+
+    The input is padded once and viewed as a grid of receptive fields with
+    stride tricks, so the whole layer is a single tensordot over (C, HH, WW).
+    This needs neither Python loops nor the compiled im2col_cython extension.
+
+    Inputs / outputs: Same as conv_forward_naive.
+    """
+    stride, pad = conv_param['stride'], conv_param['pad']
+    N, C, H, W = x.shape
+    F, _, HH, WW = w.shape
+    out_h = 1 + (H + 2 * pad - HH) // stride
+    out_w = 1 + (W + 2 * pad - WW) // stride
+
+    x_padded = np.pad(x, ((0, 0), (0, 0), (pad, pad), (pad, pad)), 'constant')
+    windows = _window_view(x_padded, HH, WW, stride)
+
+    out = np.empty((N, F, out_h, out_w), dtype=np.result_type(x, w))
+    res = np.tensordot(windows, w, axes=([1, 4, 5], [1, 2, 3]))
+    out[...] = res.transpose(0, 3, 1, 2)  # (N, H', W', F) -> (N, F, H', W')
+    out += b.reshape(1, F, 1, 1)
+
+    cache = (x, w, b, conv_param)
+    return out, cache
+
+
+def conv_backward_vectorized(dout, cache):
+    """
+    A vectorized implementation of the backward pass for a convolutional layer.
+
+    dw is one tensordot of dout against the receptive field view of the padded
+    input. dx is accumulated by looping only over the HH x WW kernel offsets,
+    adding one strided slice of the padded gradient per offset.
+
+    Inputs / outputs: Same as conv_backward_naive.
+    """
+    x, w, b, conv_param = cache
+    stride, pad = conv_param['stride'], conv_param['pad']
+    N, C, H, W = x.shape
+    F, _, HH, WW = w.shape
+    _, _, out_h, out_w = dout.shape
+
+    x_padded = np.pad(x, ((0, 0), (0, 0), (pad, pad), (pad, pad)), 'constant')
+    windows = _window_view(x_padded, HH, WW, stride)
+
+    db = dout.sum(axis=(0, 2, 3))
+    dw = np.tensordot(dout, windows, axes=([0, 2, 3], [0, 2, 3]))
+
+    dx_padded = np.zeros(x_padded.shape, dtype=np.result_type(dout, w))
+    for i in range(HH):
+        for j in range(WW):
+            dx_padded[:, :, i:i + stride * out_h:stride,
+                      j:j + stride * out_w:stride] += \
+                np.einsum('nfhw,fc->nchw', dout, w[:, :, i, j])
+    dx = dx_padded[:, :, pad:pad + H, pad:pad + W]
+
+    return dx, dw, db
+
+
 def max_pool_forward_naive(x, pool_param):
     """
     A naive implementation of the forward pass for a max pooling layer.
@@ -640,17 +858,37 @@ def max_pool_forward_naive(x, pool_param):
 
     Returns a tuple of:
     - out: Output data
-    - cache: (x, pool_param)
+    - cache: (x_shape, x_dtype, pool_param, argmax) where argmax holds the
+      flat index into x of the maximum of every pooling region
     """
     out = None
     ###########################################################################
     # TODO: Implement the max pooling forward pass                            #
     ###########################################################################
-    pass
+
+    N, C, H, W = x.shape
+    pool_height, pool_width = pool_param['pool_height'], pool_param['pool_width']
+    stride = pool_param['stride']
+    out_h = 1 + (H - pool_height) // stride
+    out_w = 1 + (W - pool_width) // stride
+
+    windows = _window_view(x, pool_height, pool_width, stride)
+    windows = windows.reshape(N, C, out_h, out_w, pool_height * pool_width)
+    offset = windows.argmax(axis=-1)
+    out = windows.max(axis=-1)
+
+    # Turn the offset inside each window into a flat index into x; int32 is
+    # enough unless x itself has more than 2**31 elements
+    index_dtype = np.int32 if x.size < 2 ** 31 else np.int64
+    rows = (stride * np.arange(out_h).reshape(-1, 1) + offset // pool_width)
+    cols = (stride * np.arange(out_w) + offset % pool_width)
+    planes = np.arange(N * C).reshape(N, C, 1, 1)
+    argmax = ((planes * H + rows) * W + cols).astype(index_dtype)
+
     ###########################################################################
     #                             END OF YOUR CODE                            #
     ###########################################################################
-    cache = (x, pool_param)
+    cache = (x.shape, x.dtype, pool_param, argmax)
     return out, cache
 
 
@@ -660,7 +898,8 @@ def max_pool_backward_naive(dout, cache):
 
     Inputs:
     - dout: Upstream derivatives
-    - cache: A tuple of (x, pool_param) as in the forward pass.
+    - cache: A tuple of (x_shape, x_dtype, pool_param, argmax) as in the
+      forward pass.
 
     Returns:
     - dx: Gradient with respect to x
@@ -669,13 +908,109 @@ def max_pool_backward_naive(dout, cache):
     ###########################################################################
     # TODO: Implement the max pooling backward pass                           #
     ###########################################################################
-    pass
+
+    x_shape, x_dtype, pool_param, argmax = cache
+    pool_height, pool_width = pool_param['pool_height'], pool_param['pool_width']
+    size = int(np.prod(x_shape))
+    if pool_param['stride'] >= max(pool_height, pool_width):
+        # Regions do not overlap, so every index appears at most once
+        dx = np.zeros(size, dtype=np.result_type(dout, x_dtype))
+        dx[argmax.ravel()] = dout.ravel()
+    else:
+        # Overlapping regions can share a maximum; bincount sums their grads
+        dx = np.bincount(argmax.ravel(), weights=dout.ravel(), minlength=size)
+        dx = dx.astype(np.result_type(dout, x_dtype), copy=False)
+    dx = dx.reshape(x_shape)
+
     ###########################################################################
     #                             END OF YOUR CODE                            #
     ###########################################################################
     return dx
 
 
+def avg_pool_forward_naive(x, pool_param):
+    """
+    Forward pass for an average pooling layer over a strided window view.
+
+    Inputs:
+    - x: Input data, of shape (N, C, H, W)
+    - pool_param: dictionary with the following keys:
+      - 'pool_height': The height of each pooling region
+      - 'pool_width': The width of each pooling region
+      - 'stride': The distance between adjacent pooling regions
+
+    Returns a tuple of:
+    - out: Output data, of shape (N, C, H', W')
+    - cache: (x_shape, pool_param)
+    """
+    pool_height, pool_width = pool_param['pool_height'], pool_param['pool_width']
+    windows = _window_view(x, pool_height, pool_width, pool_param['stride'])
+    out = windows.mean(axis=(4, 5))
+    cache = (x.shape, pool_param)
+    return out, cache
+
+
+def avg_pool_backward_naive(dout, cache):
+    """
+    Backward pass for an average pooling layer.
+
+    Inputs:
+    - dout: Upstream derivatives, of shape (N, C, H', W')
+    - cache: A tuple of (x_shape, pool_param) as in the forward pass.
+
+    Returns:
+    - dx: Gradient with respect to x
+    """
+    x_shape, pool_param = cache
+    pool_height, pool_width = pool_param['pool_height'], pool_param['pool_width']
+    stride = pool_param['stride']
+    _, _, out_h, out_w = dout.shape
+
+    # Every element of a region receives the same share of its derivative, so
+    # one strided add per offset inside the region covers overlapping regions
+    dout_share = dout / (pool_height * pool_width)
+    dx = np.zeros(x_shape, dtype=dout_share.dtype)
+    for i in range(pool_height):
+        for j in range(pool_width):
+            dx[:, :, i:i + stride * out_h:stride,
+               j:j + stride * out_w:stride] += dout_share
+    return dx
+
+
+def global_avg_pool_forward(x):
+    """
+    Forward pass for global average pooling, which averages each channel over
+    all spatial positions.
+
+    Inputs:
+    - x: Input data, of shape (N, C, H, W)
+
+    Returns a tuple of:
+    - out: Output data, of shape (N, C)
+    - cache: x_shape
+    """
+    out = x.mean(axis=(2, 3))
+    cache = x.shape
+    return out, cache
+
+
+def global_avg_pool_backward(dout, cache):
+    """
+    Backward pass for global average pooling.
+
+    Inputs:
+    - dout: Upstream derivatives, of shape (N, C)
+    - cache: x_shape, as in the forward pass
+
+    Returns:
+    - dx: Gradient with respect to x, of shape (N, C, H, W)
+    """
+    N, C, H, W = cache
+    dx = np.empty(cache, dtype=dout.dtype)
+    dx[...] = (dout / (H * W))[:, :, None, None]
+    return dx
+
+
 def spatial_batchnorm_forward(x, gamma, beta, bn_param):
     """
     Computes the forward pass for spatial batch normalization.
@@ -707,7 +1042,40 @@ def spatial_batchnorm_forward(x, gamma, beta, bn_param):
     # version of batch normalization defined above. Your implementation should#
     # be very short; ours is less than five lines.                            #
     ###########################################################################
-    pass
+
+    # Statistics are reduced over axes (0, 2, 3) of the NCHW tensor directly;
+    # going through the vanilla layer would need an NHWC transpose copy of
+    # the activation on the way in and another on the way out.
+    mode = bn_param['mode']
+    eps = bn_param.get('eps', 1e-5)
+    momentum = bn_param.get('momentum', 0.9)
+
+    N, C, H, W = x.shape
+    running_mean = bn_param.get('running_mean', np.zeros(C, dtype=x.dtype))
+    running_var = bn_param.get('running_var', np.zeros(C, dtype=x.dtype))
+
+    if mode == 'train':
+        mean = x.mean(axis=(0, 2, 3))
+        x_hat = x - mean[:, None, None]
+        var = np.einsum('nchw,nchw->c', x_hat, x_hat) / (N * H * W)
+        inv_std = 1.0 / np.sqrt(var + eps)
+        x_hat *= inv_std[:, None, None]
+        out = x_hat * gamma[:, None, None]
+        out += beta[:, None, None]
+
+        running_mean = momentum * running_mean + (1 - momentum) * mean
+        running_var = momentum * running_var + (1 - momentum) * var
+        cache = (x_hat, gamma, inv_std)
+    elif mode == 'test':
+        scale = gamma / np.sqrt(running_var + eps)
+        out = x * scale[:, None, None]
+        out += (beta - running_mean * scale)[:, None, None]
+    else:
+        raise ValueError('Invalid forward batchnorm mode "%s"' % mode)
+
+    bn_param['running_mean'] = running_mean
+    bn_param['running_var'] = running_var
+
     ###########################################################################
     #                             END OF YOUR CODE                            #
     ###########################################################################
@@ -737,7 +1105,17 @@ def spatial_batchnorm_backward(dout, cache):
     # version of batch normalization defined above. Your implementation should#
     # be very short; ours is less than five lines.                            #
     ###########################################################################
-    pass
+
+    x_hat, gamma, inv_std = cache
+    N, C, H, W = dout.shape
+    M = N * H * W
+    dbeta = dout.sum(axis=(0, 2, 3))
+    dgamma = np.einsum('nchw,nchw->c', dout, x_hat)
+    dx = x_hat * dgamma[:, None, None]
+    dx += dbeta[:, None, None]
+    np.subtract(M * dout, dx, out=dx)
+    dx *= (gamma * inv_std / M)[:, None, None]
+
     ###########################################################################
     #                             END OF YOUR CODE                            #
     ###########################################################################
@@ -772,7 +1150,7 @@ def svm_loss(x, y):
     return loss, dx
 
 
-def softmax_loss(x, y):
+def softmax_loss(x, y, smoothing=0.0, class_weights=None):
     """
     Computes the loss and gradient for softmax classification.
 
@@ -781,18 +1159,201 @@ def softmax_loss(x, y):
       class for the ith input.
     - y: Vector of labels, of shape (N,) where y[i] is the label for x[i] and
       0 <= y[i] < C
+    - smoothing: Label smoothing strength; the target puts 1 - smoothing on
+      the label and spreads smoothing evenly over all C classes.
+    - class_weights: Optional array of shape (C,) weighting the loss of each
+      example by the weight of its label. The loss is then divided by the sum
+      of the weights in the batch rather than by N.
 
     Returns a tuple of:
     - loss: Scalar giving the loss
-    - dx: Gradient of the loss with respect to x
+    - dx: Gradient of the loss with respect to x, of the same dtype as x
     """
-    shifted_logits = x - np.max(x, axis=1, keepdims=True)
-    Z = np.sum(np.exp(shifted_logits), axis=1, keepdims=True)
-    log_probs = shifted_logits - np.log(Z)
-    probs = np.exp(log_probs)
-    N = x.shape[0]
-    loss = -np.sum(log_probs[np.arange(N), y]) / N
-    dx = probs.copy()
-    dx[np.arange(N), y] -= 1
-    dx /= N
+    N, C = x.shape
+    rows = np.arange(N)
+
+    # Shifted logits, exponentials, probabilities and the gradient all live
+    # in the same buffer, which is updated in place
+    dx = x - np.max(x, axis=1, keepdims=True)
+    loss_i = -(1.0 - smoothing) * dx[rows, y]
+    if smoothing:
+        loss_i -= smoothing * dx.mean(axis=1)
+    np.exp(dx, out=dx)
+    Z = dx.sum(axis=1)
+    loss_i += np.log(Z)
+    dx /= Z[:, np.newaxis]
+
+    if smoothing:
+        dx -= smoothing / C
+    dx[rows, y] -= 1.0 - smoothing
+
+    if class_weights is None:
+        loss = np.sum(loss_i) / N
+        dx /= N
+    else:
+        weights = class_weights[y]
+        weights = weights / np.sum(weights)
+        loss = np.dot(weights, loss_i)
+        dx *= weights.astype(dx.dtype, copy=False)[:, np.newaxis]
     return loss, dx
+
+
+def _proposal_distribution(proposal, C):
+    """
+    Returns the sampling distribution over C classes for sampled_softmax_loss.
+    proposal is None or 'uniform', 'log_uniform' (Zipfian over class indices,
+    for labels sorted by decreasing frequency), or an array of shape (C,).
+    """
+    if proposal is None:
+        proposal = 'uniform'
+    if isinstance(proposal, str):
+        if proposal == 'uniform':
+            return np.full(C, 1.0 / C)
+        if proposal != 'log_uniform':
+            raise ValueError('Invalid proposal "%s"' % proposal)
+        k = np.arange(C)
+        q = np.log((k + 2.0) / (k + 1.0))
+    else:
+        q = np.asarray(proposal, dtype=np.float64)
+    return q / q.sum()
+
+
+def sampled_softmax_loss(h, w, b, y, num_sampled, proposal=None, rng=None):
+    """
+    Computes a sampled softmax loss for the affine output layer scores = h.w + b
+    without scoring all C classes.
+
+    For each minibatch, num_sampled classes are drawn with replacement from
+    the proposal distribution Q and the softmax is taken over the label and
+    the sampled classes only. Every logit has log(num_sampled * Q) subtracted
+    (the logQ correction) so that the gradient approximates that of the full
+    softmax loss; the loss itself is offset by log(num_sampled * Q[y]).
+    Sampled classes that coincide with an example's label are removed from
+    that example's softmax. Use the full scores h.w + b at test time.
+
+    Inputs:
+    - h: Input to the output layer, of shape (N, H)
+    - w: Weights of the output layer, of shape (H, C)
+    - b: Biases of the output layer, of shape (C,)
+    - y: Vector of labels, of shape (N,)
+    - num_sampled: Number of classes to sample
+    - proposal: Proposal distribution; see _proposal_distribution
+    - rng: Optional np.random.Generator to draw the samples from
+
+    Returns a tuple of:
+    - loss: Scalar giving the loss
+    - dh: Gradient with respect to h, of shape (N, H)
+    - dw: Gradient with respect to w, of shape (H, C); only the columns of the
+      labels and the sampled classes are nonzero
+    - db: Gradient with respect to b, of shape (C,)
+    """
+    N = h.shape[0]
+    C = w.shape[1]
+    q = _proposal_distribution(proposal, C)
+    if rng is None:
+        rng = np.random.default_rng()
+    sampled = rng.choice(C, size=num_sampled, p=q)
+    log_expected = np.log(num_sampled * q)
+
+    w_true = w[:, y]
+    w_sampled = w[:, sampled]
+    logits = np.empty((N, 1 + num_sampled), dtype=np.result_type(h, w))
+    logits[:, 0] = np.einsum('nh,hn->n', h, w_true) + b[y] - log_expected[y]
+    np.matmul(h, w_sampled, out=logits[:, 1:])
+    logits[:, 1:] += b[sampled] - log_expected[sampled]
+    logits[:, 1:][sampled == y[:, np.newaxis]] = -np.inf
+
+    # The label is always candidate 0
+    loss, dlogits = softmax_loss(logits, np.zeros(N, dtype=int))
+    dtrue, dsampled = dlogits[:, 0], dlogits[:, 1:]
+
+    dh = dtrue[:, np.newaxis] * w_true.T + dsampled.dot(w_sampled.T)
+    dw = np.zeros_like(w)
+    np.add.at(dw.T, y, dtrue[:, np.newaxis] * h)
+    np.add.at(dw.T, sampled, h.T.dot(dsampled).T)
+    db = (np.bincount(y, weights=dtrue, minlength=C) +
+          np.bincount(sampled, weights=dsampled.sum(axis=0), minlength=C))
+    return loss, dh, dw, db.astype(b.dtype, copy=False)
+
+
+def _softmax_clusters(y, C, K):
+    """
+    Splits C classes into K contiguous clusters of equal size S (the last one
+    may be short). Returns the cluster of each label, its position inside the
+    cluster, the (N, S) class indices of each label's cluster, a mask of which
+    of those are real classes, and S.
+    """
+    S = -(-C // K)
+    cluster, position = y // S, y % S
+    members = cluster[:, np.newaxis] * S + np.arange(S)
+    valid = members < C
+    return cluster, position, np.minimum(members, C - 1), valid, S
+
+
+def hierarchical_softmax_loss(h, w, b, wc, bc, y):
+    """
+    Computes a two-level hierarchical softmax loss.
+
+    The C classes are split into K contiguous clusters, and the probability of
+    a class factors as p(cluster | h) * p(class | cluster, h). The first factor
+    is a softmax over the K cluster scores h.wc + bc, the second a softmax over
+    the scores h.w + b of the classes in the label's cluster, so each example
+    costs O(H * (K + C / K)) instead of O(H * C).
+
+    Inputs:
+    - h: Input to the output layer, of shape (N, H)
+    - w: Class weights, of shape (H, C)
+    - b: Class biases, of shape (C,)
+    - wc: Cluster weights, of shape (H, K)
+    - bc: Cluster biases, of shape (K,)
+    - y: Vector of labels, of shape (N,)
+
+    Returns a tuple of:
+    - loss: Scalar giving the loss
+    - dh, dw, db, dwc, dbc: Gradients with respect to h, w, b, wc and bc
+    """
+    C = w.shape[1]
+    cluster, position, members, valid, S = _softmax_clusters(y, C, wc.shape[1])
+
+    loss_cluster, dcluster = softmax_loss(h.dot(wc) + bc, cluster)
+
+    w_leaf = w.T[members]
+    leaf = np.einsum('nsh,nh->ns', w_leaf, h) + b[members]
+    leaf[~valid] = -np.inf
+    loss_leaf, dleaf = softmax_loss(leaf, position)
+
+    loss = loss_cluster + loss_leaf
+    dh = dcluster.dot(wc.T) + np.einsum('ns,nsh->nh', dleaf, w_leaf)
+    dwc = h.T.dot(dcluster)
+    dbc = dcluster.sum(axis=0)
+    dw = np.zeros_like(w)
+    np.add.at(dw.T, members, dleaf[:, :, np.newaxis] * h[:, np.newaxis, :])
+    db = np.bincount(members.ravel(), weights=dleaf.ravel(), minlength=C)
+    return loss, dh, dw, db.astype(b.dtype, copy=False), dwc, dbc
+
+
+def hierarchical_softmax_scores(h, w, b, wc, bc):
+    """
+    Computes the full log-probabilities of all C classes under the model of
+    hierarchical_softmax_loss, for use at test time.
+
+    Inputs: Same as hierarchical_softmax_loss, without y
+
+    Returns:
+    - scores: Array of shape (N, C) holding log p(class | h)
+    """
+    N = h.shape[0]
+    C = w.shape[1]
+    K = wc.shape[1]
+    S = -(-C // K)
+
+    def log_softmax(s, axis):
+        s = s - np.max(s, axis=axis, keepdims=True)
+        return s - np.log(np.sum(np.exp(s), axis=axis, keepdims=True))
+
+    leaf = np.full((N, K * S), -np.inf, dtype=np.result_type(h, w))
+    np.matmul(h, w, out=leaf[:, :C])
+    leaf[:, :C] += b
+    leaf = log_softmax(leaf.reshape(N, K, S), 2)
+    leaf += log_softmax(h.dot(wc) + bc, 1)[:, :, np.newaxis]
+    return leaf.reshape(N, K * S)[:, :C]
@@ -0,0 +1,88 @@
+from __future__ import print_function
+import functools
+import sys
+
+import numpy as np
+
+import cs231n.layer_utils
+
+
+def _float_arrays(values):
+    """ Yields the floating point arrays found in nested tuples / lists. """
+    for v in values:
+        if isinstance(v, np.ndarray) and np.issubdtype(v.dtype, np.floating):
+            yield v
+        elif isinstance(v, (tuple, list)):
+            for a in _float_arrays(v):
+                yield a
+
+
+def _is_layer(name, value):
+    return callable(value) and not name.startswith('_') and \
+        name.endswith(('_forward', '_backward', '_loss', '_scores'))
+
+
+def _audited(name, func, promotions):
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        result = func(*args, **kwargs)
+        inputs = list(_float_arrays(list(args) + list(kwargs.values())))
+        if inputs:
+            widest = max(a.dtype.itemsize for a in inputs)
+            outputs = result if isinstance(result, tuple) else (result,)
+            for i, out in enumerate(outputs):
+                # Caches are nested tuples; only the returned arrays count
+                if (isinstance(out, np.ndarray) and
+                        np.issubdtype(out.dtype, np.floating) and
+                        out.dtype.itemsize > widest):
+                    promotions.append((name, i, str(out.dtype),
+                                       str(np.dtype('f%d' % widest))))
+        return result
+    return wrapper
+
+
+def audit_dtypes(model, X, y, verbose=True):
+    """
+    Runs one training forward / backward pass of model and reports every layer
+    that returns a floating point array wider than all of its floating point
+    inputs, e.g. float64 gradients from float32 activations.
+
+    Every *_forward, *_backward, *_loss and *_scores function visible to the
+    model's module and to cs231n.layer_utils is wrapped for the duration of
+    the pass, so sandwich layers are checked as well as the layers they call.
+
+    Inputs:
+    - model: A model object conforming to the Solver API
+    - X, y: A minibatch of data and labels
+    - verbose: If True, print each promotion found
+
+    Returns:
+    - promotions: List of (layer name, output index, output dtype, widest
+      input dtype), one per offending output; empty if nothing was promoted.
+      Parameter gradients wider than the parameters are reported under the
+      name 'grads[<param>]'.
+    """
+    promotions = []
+    modules = [sys.modules[type(model).__module__], cs231n.layer_utils]
+    originals = []
+    for module in modules:
+        for name, value in list(vars(module).items()):
+            if _is_layer(name, value):
+                originals.append((module, name, value))
+                setattr(module, name, _audited(name, value, promotions))
+    try:
+        _, grads = model.loss(X, y)
+    finally:
+        for module, name, value in originals:
+            setattr(module, name, value)
+
+    for k, dw in sorted(grads.items()):
+        w = model.params[k]
+        if dw.dtype.itemsize > w.dtype.itemsize:
+            promotions.append(('grads[%s]' % k, 0, str(dw.dtype), str(w.dtype)))
+
+    if verbose:
+        for name, i, got, widest in promotions:
+            print('%s: output %d is %s, inputs are at most %s' % (
+                  name, i, got, widest))
+    return promotions
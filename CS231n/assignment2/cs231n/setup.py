@@ -1,11 +1,18 @@
+import sys
 from distutils.core import setup
 from distutils.extension import Extension
 from Cython.Build import cythonize
 import numpy
 
+# The im2col / col2im kernels run their outer loop on OpenMP threads. Apple's
+# clang ships without OpenMP, so on macOS they are built single-threaded.
+openmp_flags = [] if sys.platform == 'darwin' else ['-fopenmp']
+
 extensions = [
   Extension('im2col_cython', ['im2col_cython.pyx'],
-            include_dirs = [numpy.get_include()]
+            include_dirs = [numpy.get_include()],
+            extra_compile_args = ['-O3'] + openmp_flags,
+            extra_link_args = openmp_flags,
   ),
 ]
 
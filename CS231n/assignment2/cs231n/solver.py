@@ -77,6 +77,9 @@ class Solver(object):
       - loss: Scalar giving the loss
       - grads: Dictionary with the same keys as self.params mapping parameter
         names to gradients of the loss with respect to those parameters.
+
+    - If the model has a non-empty model.dropout_param dictionary, its 'step'
+      is advanced after every training step so that dropout draws a new mask.
     """
 
     def __init__(self, model, data, **kwargs):
@@ -113,6 +116,17 @@ class Solver(object):
           accuracy; default is None, which uses the entire validation set.
         - checkpoint_name: If not None, then save model checkpoints here every
           epoch.
+        - master_dtype: If not None, the Solver keeps a master copy of the
+          parameters in this dtype (e.g. np.float32 for a float16 model). The
+          update rules run on the master copy, and the model gets a cast of
+          it after every step.
+        - loss_scale: Factor the model multiplies its gradients by; the Solver
+          divides it back out before the update. Pass 'dynamic' to start at
+          2 ** 15, halve it and skip the step whenever a gradient overflows,
+          and double it after loss_scale_window overflow-free steps. The
+          model must have a loss_scale attribute, as FullyConnectedNet does.
+        - loss_scale_window: Number of overflow-free steps between increases
+          of a dynamic loss scale; default is 1000.
         """
         self.model = model
         self.X_train = data['X_train']
@@ -132,6 +146,9 @@ class Solver(object):
         self.checkpoint_name = kwargs.pop('checkpoint_name', None)
         self.print_every = kwargs.pop('print_every', 10)
         self.verbose = kwargs.pop('verbose', True)
+        self.master_dtype = kwargs.pop('master_dtype', None)
+        self.loss_scale = kwargs.pop('loss_scale', None)
+        self.loss_scale_window = kwargs.pop('loss_scale_window', 1000)
 
         # Throw an error if there are extra keyword arguments
         if len(kwargs) > 0:
@@ -144,6 +161,12 @@ class Solver(object):
             raise ValueError('Invalid update_rule "%s"' % self.update_rule)
         self.update_rule = getattr(optim, self.update_rule)
 
+        self.dynamic_loss_scale = self.loss_scale == 'dynamic'
+        if self.dynamic_loss_scale:
+            self.loss_scale = 2.0 ** 15
+        if self.loss_scale is not None and not hasattr(model, 'loss_scale'):
+            raise ValueError('Model does not support loss scaling')
+
         self._reset()
 
 
@@ -159,6 +182,10 @@ class Solver(object):
         self.loss_history = []
         self.train_acc_history = []
         self.val_acc_history = []
+        self.skipped_steps = 0
+        self.good_steps = 0
+
+        self._reset_master_params()
 
         # Make a deep copy of the optim_config for each parameter
         self.optim_configs = {}
@@ -179,16 +206,70 @@ class Solver(object):
         y_batch = self.y_train[batch_mask]
 
         # Compute loss and gradient
-        loss, grads = self.model.loss(X_batch, y_batch)
+        if self.loss_scale is not None:
+            self.model.loss_scale = self.loss_scale
+        if self.dynamic_loss_scale:
+            # Overflows are expected while the scale settles; they are caught
+            # below and the step is skipped
+            with np.errstate(over='ignore', invalid='ignore'):
+                loss, grads = self.model.loss(X_batch, y_batch)
+        else:
+            loss, grads = self.model.loss(X_batch, y_batch)
         self.loss_history.append(loss)
 
-        # Perform a parameter update
-        for p, w in self.model.params.items():
+        # Seeded dropout draws its masks from (seed, step, layer)
+        dropout_param = getattr(self.model, 'dropout_param', None)
+        if dropout_param:
+            dropout_param['step'] = dropout_param.get('step', 0) + 1
+
+        if self.master_dtype is not None:
+            grads = {p: dw.astype(self.master_dtype) for p, dw in grads.items()}
+        if self.loss_scale is not None:
+            grads = {p: dw / self.loss_scale for p, dw in grads.items()}
+            if self.dynamic_loss_scale and not self._update_loss_scale(grads):
+                return
+
+        # Perform a parameter update; train() may have replaced the model's
+        # params dictionary, so without a master_dtype update it directly
+        if self.master_dtype is None:
+            self.master_params = self.model.params
+        for p, w in self.master_params.items():
             dw = grads[p]
             config = self.optim_configs[p]
             next_w, next_config = self.update_rule(w, dw, config)
-            self.model.params[p] = next_w
+            self.master_params[p] = next_w
             self.optim_configs[p] = next_config
+        if self.master_dtype is not None:
+            for p, w in self.master_params.items():
+                self.model.params[p] = w.astype(self.model.params[p].dtype)
+
+    def _reset_master_params(self):
+        """
+        Copy the model's parameters into master_params. Don't call this
+        manually.
+        """
+        # Updates are applied to these, in master_dtype if one was given.
+        # Without one, _step updates self.model.params directly.
+        self.master_params = self.model.params
+        if self.master_dtype is not None:
+            self.master_params = {k: v.astype(self.master_dtype)
+                                  for k, v in self.model.params.items()}
+
+    def _update_loss_scale(self, grads):
+        """
+        Adjust the dynamic loss scale after a backward pass. Returns False if
+        a gradient overflowed, in which case the step should be skipped.
+        """
+        if all(np.all(np.isfinite(dw)) for dw in grads.values()):
+            self.good_steps += 1
+            if self.good_steps == self.loss_scale_window:
+                self.loss_scale *= 2
+                self.good_steps = 0
+            return True
+        self.loss_scale = max(self.loss_scale / 2, 1.0)
+        self.good_steps = 0
+        self.skipped_steps += 1
+        return False
 
 
     def _save_checkpoint(self):
@@ -304,3 +385,4 @@ class Solver(object):
 
         # At the end of training swap the best params into the model
         self.model.params = self.best_params
+        self._reset_master_params()